@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Reading the time a photo was taken from its EXIF data
+#
+# JPEG and TIFF files are read directly: the APP1 segment of a JPEG holds a
+# TIFF structure whose IFDs point to the timestamp tags. Only the first few
+# KiB of a file are read, plus whatever the IFDs point to beyond them. Other
+# files are left to exiv2, which is run for many files at once.
+#
+
+import os, struct, subprocess
+from calendar import timegm
+from time import strptime
+
+# how much of a file to read at first; the IFDs usually lie within it
+HEAD = 1 << 13
+# the IFD that holds the tags of the camera rather than the image
+EXIF_IFD = 0x8769
+# the timestamps in the order they are tried, each with the tags of its
+# fractional seconds and its UTC offset: DateTimeOriginal,
+# DateTimeDigitized and DateTime
+TIMESTAMP_TAGS = ((0x9003, 0x9291, 0x9011), (0x9004, 0x9292, 0x9012), (0x0132, 0x9290, 0x9010))
+ASCII, LONG, IFD = 2, 4, 13
+# the exiv2 keys of TIMESTAMP_TAGS
+TIMESTAMP_KEYS = (("Exif.Photo.DateTimeOriginal", "Exif.Photo.SubSecTimeOriginal", "Exif.Photo.OffsetTimeOriginal"),
+                  ("Exif.Photo.DateTimeDigitized", "Exif.Photo.SubSecTimeDigitized", "Exif.Photo.OffsetTimeDigitized"),
+                  ("Exif.Image.DateTime", "Exif.Photo.SubSecTime", "Exif.Photo.OffsetTime"))
+# the most files to pass to a single exiv2 process
+BATCH_SIZE = 500
+
+
+def tiffOffset(read):
+    """Return the offset of the TIFF structure with the EXIF data in a file,
+       given read(offset, size), or None if the file is neither a TIFF nor a
+       JPEG file with EXIF data.
+    """
+    if read(0, 4) in (b"II*\0", b"MM\0*"):
+        return 0
+    if read(0, 2) != b"\xff\xd8":
+        return None
+    position = 2
+    while True:
+        marker = read(position, 4)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        if marker[1] == 0xff:
+            # a fill byte
+            position += 1
+            continue
+        if marker[1] in (0xd9, 0xda):
+            # the end of the image or the start of its data; the EXIF data comes before
+            return None
+        if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:
+            # markers without a segment
+            position += 2
+            continue
+        if len(marker) < 4:
+            return None
+        if marker[1] == 0xe1 and read(position + 4, 6) == b"Exif\0\0":
+            return position + 10
+        position += 2 + struct.unpack(">H", marker[2:])[0]
+
+def readEntries(read, base, order, offset):
+    """Return the entries of the IFD at offset in a TIFF structure at base as
+       a dict from tags to (type, count, value) with the raw four bytes of
+       the value or its offset.
+    """
+    count, = struct.unpack(order + "H", read(base + offset, 2))
+    data = read(base + offset + 2, 12*count)
+    if len(data) != 12*count:
+        raise ValueError("truncated IFD")
+    entries = {}
+    for position in range(0, len(data), 12):
+        tag, type, count = struct.unpack_from(order + "HHI", data, position)
+        entries[tag] = (type, count, data[position + 8:position + 12])
+    return entries
+
+def readString(read, base, order, entry):
+    """Return the value of an ASCII entry, see readEntries.
+    """
+    type, count, value = entry
+    if type != ASCII:
+        raise ValueError("not an ASCII entry")
+    if count > 4:
+        value = read(base + struct.unpack(order + "I", value)[0], count)
+    return value[:count].split(b"\0", 1)[0].decode("ascii").strip()
+
+def readTimestamp(filename):
+    """Return the time a JPEG or TIFF file was taken as the EXIF strings
+       (timestamp, fractional seconds, UTC offset); those of the latter two
+       that the file does not have are None.
+
+       Return None if the file cannot be read this way or has no timestamp.
+    """
+    try:
+        with open(filename, "rb") as file:
+            head = file.read(HEAD)
+            def read(offset, size):
+                if offset + size <= len(head):
+                    return head[offset:offset + size]
+                file.seek(offset)
+                return file.read(size)
+            base = tiffOffset(read)
+            if base is None:
+                return None
+            order = {b"II": "<", b"MM": ">"}.get(read(base, 2))
+            if order is None:
+                return None
+            entries = readEntries(read, base, order, struct.unpack(order + "I", read(base + 4, 4))[0])
+            if EXIF_IFD in entries and entries[EXIF_IFD][0] in (LONG, IFD):
+                entries.update(readEntries(read, base, order, struct.unpack(order + "I", entries[EXIF_IFD][2])[0]))
+            for tags in TIMESTAMP_TAGS:
+                if tags[0] in entries:
+                    return tuple(readString(read, base, order, entries[tag]) if tag in entries else None for tag in tags)
+    except (OSError, ValueError, struct.error):
+        pass
+    return None
+
+def commandBatches(command, arguments, size=BATCH_SIZE):
+    """Split arguments into lists of at most size that fit onto a command
+       line after command, so that none exceeds ARG_MAX.
+    """
+    try:
+        limit = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        limit = 1 << 15
+    # the environment shares the space; every argument also takes a pointer
+    environment = sum(len(key) + len(value) + 10 for (key, value) in os.environ.items())
+    limit = max(limit - environment - sum(len(os.fsencode(argument)) + 9 for argument in command) - 4096, 1 << 12)
+    batch, length = [], 0
+    for argument in arguments:
+        argumentLength = len(os.fsencode(argument)) + 9
+        if batch and (len(batch) == size or length + argumentLength > limit):
+            yield batch
+            batch, length = [], 0
+        batch.append(argument)
+        length += argumentLength
+    if batch:
+        yield batch
+
+def readTimestampsExiv2(filenames):
+    """Return the timestamps of files like readTimestamp, but read with exiv2.
+
+       exiv2 is run for up to BATCH_SIZE files at a time and asked for the
+       keys of TIMESTAMP_KEYS only. Return a list parallel to filenames
+       with None for the files that have no timestamp or that exiv2 cannot
+       read.
+    """
+    keys = [key for tags in TIMESTAMP_KEYS for key in tags]
+    command = ["exiv2", "-q", "-Pkv"] + [option for key in keys for option in ("-K", key)] + ["pr"]
+    # exiv2 gets the names as bytes, so that it prints them as they are;
+    # names that look like options are made relative
+    names = [os.fsencode(filename) for filename in filenames]
+    names = [os.path.join(b".", name) if name.startswith(b"-") else name for name in names]
+    timestamps = []
+    for batch in commandBatches(command, names):
+        # with more than one file, exiv2 starts every line with the name of its file
+        values = [{} for name in batch]
+        stdout = subprocess.Popen(command + batch, stdout=subprocess.PIPE).communicate()[0]
+        current = 0
+        for line in stdout.split(b"\n"):
+            if len(batch) > 1:
+                # the files are printed in order; take the longest name that
+                # fits in case one name starts with another
+                matches = [i for i in range(current, len(batch)) if line.startswith(batch[i])]
+                if not matches:
+                    continue
+                current = max(matches, key=lambda i: len(batch[i]))
+                line = line[len(batch[current]):]
+            items = line.split(None, 1)
+            if len(items) == 2 and items[0].decode("latin-1") in keys:
+                values[current][items[0].decode("latin-1")] = items[1].strip().decode("latin-1")
+        for value in values:
+            timestamps.append(next((tuple(value.get(key) for key in tags) for tags in TIMESTAMP_KEYS if tags[0] in value), None))
+    return timestamps
+
+def parseExifTime(timestamp, subseconds=None, offset=None):
+    """Convert the EXIF strings of a timestamp, its fractional seconds and its
+       UTC offset to the seconds since the epoch as if the timestamp were in
+       UTC and the offset in seconds, or None for an offset that is missing
+       or invalid. Raise ValueError if the timestamp is invalid.
+
+       >>> parseExifTime("2006:08:08 17:54:47", "25", "+02:00")
+       (1155059687.25, 7200)
+       >>> parseExifTime("2006:08:08 17:54:47", "", "  :  ")
+       (1155059687, None)
+       >>> parseExifTime("    :  :     :  :  ") # doctest: +ELLIPSIS
+       Traceback (most recent call last):
+       ...
+       ValueError: time data ... does not match format '%Y:%m:%d %H:%M:%S'
+    """
+    seconds = timegm(strptime(timestamp.strip(), "%Y:%m:%d %H:%M:%S"))
+    if subseconds and subseconds.strip().isdigit():
+        subseconds = subseconds.strip()
+        seconds += int(subseconds) / 10**len(subseconds)
+    if offset and len(offset) == 6 and offset[0] in "+-" and offset[3] == ':' \
+            and offset[1:3].isdigit() and offset[4:].isdigit():
+        offset = (int(offset[1:3])*3600 + int(offset[4:])*60) * (-1 if offset[0] == '-' else 1)
+    else:
+        offset = None
+    return seconds, offset
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Reading and writing EXIF data with long-lived exiftool processes
+#
+# exiftool -stay_open True -@ - reads its arguments line by line from a pipe
+# and runs them as a command whenever it gets -execute, so that a single
+# process serves any number of photos instead of one process per photo.
+#
+
+import json, os, queue, subprocess, threading
+from contextlib import contextmanager
+
+# the exiftool tags of the timestamps, see exifparse.TIMESTAMP_TAGS
+TIMESTAMP_NAMES = (("DateTimeOriginal", "SubSecTimeOriginal", "OffsetTimeOriginal"),
+                   ("CreateDate", "SubSecTimeDigitized", "OffsetTimeDigitized"),
+                   ("ModifyDate", "SubSecTime", "OffsetTime"))
+
+
+class ExifToolError(Exception):
+    """exiftool could not carry out a command
+    """
+    pass
+
+
+class ExifTool:
+    """An exiftool process that runs commands one after another
+
+       The output of every command ends with {readyN} on stdout, where N
+       counts the commands; its error messages are delimited on stderr with
+       the same marker by -echo4.
+    """
+    def __init__(self, executable="exiftool"):
+        self.process = subprocess.Popen([executable, "-stay_open", "True", "-@", "-"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.count = 0
+        # stderr is drained by a thread, so that neither pipe can fill up
+        # while we are waiting for the other one
+        self.errors = queue.Queue()
+        threading.Thread(target=self.readErrors, daemon=True).start()
+
+    def readErrors(self):
+        for line in self.process.stderr:
+            self.errors.put(line)
+        self.errors.put(None)
+
+    def execute(self, arguments):
+        """Run exiftool with arguments and return its output and its error messages.
+        """
+        self.count += 1
+        ready = b"{ready%d}" % self.count
+        lines = [os.fsencode(argument) for argument in arguments] + [b"-echo4", ready, b"-execute%d" % self.count]
+        if any(b"\n" in line for line in lines):
+            raise ValueError("exiftool cannot take arguments with line breaks")
+        self.process.stdin.write(b"\n".join(lines) + b"\n")
+        self.process.stdin.flush()
+        output = []
+        for line in self.process.stdout:
+            if line.rstrip().endswith(ready):
+                output.append(line.rstrip()[:-len(ready)])
+                break
+            output.append(line)
+        else:
+            raise ExifToolError("exiftool exited unexpectedly")
+        errors = []
+        for line in iter(self.errors.get, None):
+            if line.rstrip() == ready:
+                break
+            errors.append(line)
+        return b"".join(output), b"".join(errors)
+
+    def readTimestamp(self, filename):
+        """Return the timestamp of a file like exifparse.readTimestamp, but read with exiftool.
+        """
+        output, errors = self.execute(["-json"] + ["-EXIF:" + name for names in TIMESTAMP_NAMES for name in names] + [filename])
+        values = json.loads(output.decode("utf-8", "replace")) if output.strip() else []
+        if not values:
+            return None
+        # exiftool gives numbers as numbers; those with leading zeros are strings
+        values = dict((name, str(value)) for (name, value) in values[0].items())
+        return next((tuple(values.get(name) for name in names) for names in TIMESTAMP_NAMES if names[0] in values), None)
+
+    def writeTags(self, filename, tags):
+        """Set the tags, a list of (name, value), on a file in place and keep
+           its modification time.
+
+           Raise ExifToolError if the file was not updated.
+        """
+        output, errors = self.execute(["-P", "-overwrite_original"] + ["-%s=%s" % tag for tag in tags] + [filename])
+        if b"1 image files updated" not in output and b"1 image files unchanged" not in output:
+            raise ExifToolError((errors or output).decode("utf-8", "replace").strip())
+
+    def close(self):
+        """Let the process exit once it is done with all commands.
+        """
+        if self.process.poll() is None:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            self.process.stdin.close()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class ExifToolPool:
+    """ExifTool processes that threads borrow, see borrow
+
+       A process is only started when all others are busy, so there are
+       never more of them than threads using them at the same time.
+    """
+    def __init__(self, executable="exiftool"):
+        self.executable = executable
+        self.idle = []
+        self.tools = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def borrow(self):
+        """Lend an idle ExifTool, started if need be, for a with block.
+        """
+        with self.lock:
+            tool = self.idle.pop() if self.idle else None
+        if tool is None:
+            tool = ExifTool(self.executable)
+            with self.lock:
+                self.tools.append(tool)
+        try:
+            yield tool
+        finally:
+            # a process that has exited is not lent again
+            if tool.process.poll() is None:
+                with self.lock:
+                    self.idle.append(tool)
+
+    def close(self):
+        with self.lock:
+            for tool in self.tools:
+                tool.close()
+            self.tools, self.idle = [], []
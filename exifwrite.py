@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Writing the GPS tags of a photo into its EXIF data without running exiv2
+#
+# exiv2 writes a whole new file to change a few tags. Here the tags are
+# changed where they are if their entries and values have the room, as they
+# do once a photo has been geotagged, through a memory map of the file.
+# Otherwise the values, and the IFDs that lack entries for the tags, are
+# appended to the TIFF structure of the APP1 segment of a JPEG file; only
+# the segments up to it are written anew and the rest of the file is copied
+# by the kernel. Nothing else in the TIFF structure moves, so that the
+# offsets in maker notes stay valid.
+#
+# What is replaced stays behind unused. A comment only grows, since a
+# shorter one keeps the room of the one it replaces, and one that ends the
+# structure grows where it is, so that tagging a photo again and again
+# writes it in place once its comment has been as long as it gets, and
+# leaves at most one unused comment behind besides the IFDs replaced on the
+# first run.
+#
+
+import mmap, os, struct, tempfile
+from exifparse import tiffOffset, readEntries, EXIF_IFD, ASCII, LONG, IFD
+from gpsfuncs import decToDMS, formatAsRational
+
+# the tags that point to the GPS IFD and to the comment in the EXIF IFD
+GPS_IFD = 0x8825
+USER_COMMENT = 0x9286
+BYTE, RATIONAL, UNDEFINED = 1, 5, 7
+# the size of a value of each TIFF type
+TYPE_SIZES = {BYTE: 1, ASCII: 1, 3: 2, LONG: 4, RATIONAL: 8, 6: 1, UNDEFINED: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, IFD: 4}
+# the largest TIFF structure that fits into an APP1 segment after its
+# length and the Exif header
+APP1_SIZE = 0xffff - 8
+
+
+def rational(number):
+    """Return number as (numerator, denominator) as exiv2 gets it from
+       formatAsRational, with as many digits dropped as a LONG needs.
+
+       >>> rational(33.7488)
+       (337488, 10000)
+       >>> rational(8848.123456)
+       (884812345, 100000)
+    """
+    numerator, denominator = [int(part or 0) for part in formatAsRational(number).split("/")]
+    while numerator >= 1 << 32:
+        numerator, denominator = numerator // 10, max(denominator // 10, 1)
+    return numerator, denominator
+
+def gpsTags(order, trackpoint):
+    """Return the tags of geotag.setExif for trackpoint as dicts for the GPS
+       IFD and for the EXIF IFD from tags to (type, count, data).
+    """
+    def ascii(value):
+        return (ASCII, len(value) + 1, value.encode("ascii") + b"\0")
+    def rationals(*numbers):
+        return (RATIONAL, len(numbers), b"".join(struct.pack(order + "II", *rational(number)) for number in numbers))
+    comment = b"ASCII\0\0\0" + trackpoint.getstr().encode("ascii")
+    return ({0x00: (BYTE, 4, bytes((2, 2, 0, 0))),
+             0x01: ascii(("N", "S")[trackpoint.lat < 0]),
+             0x02: rationals(*decToDMS(abs(trackpoint.lat))),
+             0x03: ascii(("E", "W")[trackpoint.lon < 0]),
+             0x04: rationals(*decToDMS(abs(trackpoint.lon))),
+             0x05: (BYTE, 1, bytes(((0, 1)[trackpoint.ele < 0],))),
+             0x06: rationals(abs(trackpoint.ele)),
+             0x12: ascii("WGS-84")},
+            {USER_COMMENT: (UNDEFINED, len(comment), comment)})
+
+def setEntries(read, order, offset, tags, size):
+    """Set tags, a dict from tags to (type, count, data), in the IFD at
+       offset of a TIFF structure of size bytes, given read(offset, size)
+       relative to its start, or in a new IFD if offset is None.
+
+       Return the offset of the IFD, the changes to the structure as a list
+       of (offset, data) and its size after them. If the IFD has entries for
+       all tags, they are changed where they are, and so are their values if
+       they fit over the old ones; the others are appended. A value that
+       replaces one that ends the structure, as an appended value does,
+       takes its place. A string shorter than the one it replaces keeps its
+       count, padded with NULs, which exiv2 drops when it reads it.
+       Otherwise the IFD is appended with all its entries, and the values
+       that do not fit into them after it.
+    """
+    if offset is None:
+        entries, positions, next = {}, {}, b"\0"*4
+    else:
+        entries = readEntries(read, 0, order, offset)
+        count, = struct.unpack(order + "H", read(offset, 2))
+        if offset + 6 + 12*count > size:
+            raise ValueError("IFD beyond the TIFF structure")
+        # the last of several entries of a tag counts, as in readEntries
+        positions = dict((struct.unpack(order + "H", read(position, 2))[0], position)
+                         for position in range(offset + 2, offset + 2 + 12*count, 12))
+        next = read(offset + 2 + 12*count, 4)
+    if all(tag in entries for tag in tags):
+        changes = []
+        for (tag, (type, count, data)) in tags.items():
+            oldType, oldCount, value = entries[tag]
+            # the old value, unless it is in the entry or of an unknown type
+            oldSize = oldCount*TYPE_SIZES.get(oldType, 0)
+            position = struct.unpack(order + "I", value)[0] if oldSize > 4 else None
+            if position is not None and position + oldSize > size:
+                position = None
+            if len(data) <= 4:
+                value = data.ljust(4, b"\0")
+            else:
+                if position is not None and type == oldType and type in (ASCII, UNDEFINED) and count < oldCount:
+                    # a shorter string keeps the room of the old one, padded
+                    # with NULs, so that a longer one fits there again
+                    count, data = oldCount, data.ljust(oldSize, b"\0")
+                if position is not None and position + oldSize + oldSize % 2 >= size:
+                    # the old value ends the structure, so the new one does
+                    size = max(size, position + len(data))
+                elif position is not None and len(data) <= oldSize:
+                    data = data.ljust(oldSize, b"\0")
+                else:
+                    position = size + size % 2
+                    size = position + len(data)
+                changes.append((position, data))
+                value = struct.pack(order + "I", position)
+            changes.append((positions[tag] + 2, struct.pack(order + "HI", type, count) + value))
+        return offset, changes, size
+
+    # append the IFD, aligned to a word as all offsets in TIFF
+    offset = size + size % 2
+    end = offset + 6 + 12*len(set(entries) | set(tags))
+    entries = dict((tag, struct.pack(order + "HHI", tag, *entry[:2]) + entry[2]) for (tag, entry) in entries.items())
+    data = b""
+    for (tag, (type, count, value)) in tags.items():
+        if len(value) <= 4:
+            value = value.ljust(4, b"\0")
+        else:
+            position = end + len(data)
+            data += value + b"\0"*(len(value) % 2)
+            value = struct.pack(order + "I", position)
+        entries[tag] = struct.pack(order + "HH", tag, type) + struct.pack(order + "I", count) + value
+    ifd = struct.pack(order + "H", len(entries)) + b"".join(entries[tag] for tag in sorted(entries)) + next + data
+    return offset, [(offset, ifd)], offset + len(ifd)
+
+def copyRange(source, target, offset, count):
+    """Copy count bytes from offset of the file descriptor source to the
+       current position of the file descriptor target, within the kernel
+       with copy_file_range (which file systems like Btrfs or XFS can do by
+       sharing blocks) or sendfile where they are available.
+    """
+    methods = [lambda count: os.copy_file_range(source, target, count, offset)] if hasattr(os, "copy_file_range") else []
+    if hasattr(os, "sendfile"):
+        methods.append(lambda count: os.sendfile(target, source, offset, count))
+    methods.append(lambda count: os.write(target, os.pread(source, min(count, 1 << 20), offset)))
+    end = offset + count
+    while offset < end:
+        try:
+            copied = methods[0](end - offset)
+        except OSError:
+            # not between these files, try the next method
+            if len(methods) == 1:
+                raise
+            methods.pop(0)
+            continue
+        if copied == 0:
+            raise OSError("%d bytes short of the end of file" % (end - offset))
+        offset += copied
+
+def writeGPS(filename, trackpoint):
+    """Set the EXIF tags of geotag.setExif for trackpoint on a JPEG or TIFF
+       file and keep its modification time.
+
+       Return False, without changing the file, if it cannot be written this
+       way: if it has no EXIF data, if its IFDs cannot be read or if they
+       need more room and it is not a JPEG file with room in its APP1
+       segment. Raise OSError if the file cannot be read or written.
+    """
+    with open(filename, "r+b") as file:
+        stat = os.fstat(file.fileno())
+        if stat.st_size == 0:
+            return False
+        with mmap.mmap(file.fileno(), 0) as contents:
+            def read(offset, size):
+                return contents[offset:offset + size]
+            try:
+                base = tiffOffset(read)
+                if base is None:
+                    return False
+                order = {b"II": "<", b"MM": ">"}.get(read(base, 2))
+                if order is None:
+                    return False
+                # the TIFF structure of a JPEG file ends with its APP1 segment
+                size = end = struct.unpack(">H", read(base - 8, 2))[0] - 8 if base else stat.st_size
+                def readTiff(offset, size):
+                    return read(base + offset, size)
+                first, = struct.unpack(order + "I", readTiff(4, 4))
+                entries = readEntries(readTiff, 0, order, first)
+                gpsTagValues, exifTagValues = gpsTags(order, trackpoint)
+                pointers = {}
+                changes = []
+                for (tag, tagValues) in ((GPS_IFD, gpsTagValues), (EXIF_IFD, exifTagValues)):
+                    offset = struct.unpack(order + "I", entries[tag][2])[0] if tag in entries else None
+                    pointers[tag], ifdChanges, size = setEntries(readTiff, order, offset, tagValues, size)
+                    changes += ifdChanges
+                pointers = dict((tag, (LONG, 1, struct.pack(order + "I", offset))) for (tag, offset) in pointers.items())
+                offset, ifdChanges, size = setEntries(readTiff, order, first, pointers, size)
+                changes += ifdChanges
+                if offset != first:
+                    changes.append((4, struct.pack(order + "I", offset)))
+            except (ValueError, struct.error):
+                return False
+
+            if size == end:
+                # everything fits, change the bytes in place
+                for (offset, data) in changes:
+                    contents[base + offset:base + offset + len(data)] = data
+                contents.flush()
+            elif base and size <= APP1_SIZE:
+                # write the segments up to the new APP1 segment and copy the rest
+                tiff = bytearray(read(base, min(size, end))) + bytearray(max(size - end, 0))
+                for (offset, data) in changes:
+                    tiff[offset:offset + len(data)] = data
+                directory, name = os.path.split(filename)
+                descriptor, temporary = tempfile.mkstemp(prefix="." + name, suffix=".tmp", dir=directory or ".")
+                try:
+                    with os.fdopen(descriptor, "wb") as target:
+                        target.write(read(0, base - 8) + struct.pack(">H", size + 8) + b"Exif\0\0" + tiff)
+                        target.flush()
+                        copyRange(file.fileno(), target.fileno(), base + end, stat.st_size - base - end)
+                    os.chmod(temporary, stat.st_mode & 0o7777)
+                    os.replace(temporary, filename)
+                except BaseException:
+                    os.unlink(temporary)
+                    raise
+            else:
+                return False
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return True
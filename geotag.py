@@ -14,18 +14,30 @@
 # Additions/modifications by Mike Pickering
 # Interpolation, Python 3 compliance by Julian Rueth, August 2010
 
-import re, os, tempfile, sys, subprocess, traceback
-from argparse import ArgumentParser
-from math import pi, sin, cos, atan2, sqrt
-from time import strptime, mktime, strftime, gmtime
-from gpsfuncs import decToDMS, formatAsRational, Trackpoint
-from xml.dom import minidom
+import re, os, shutil, tempfile, sys, subprocess, threading
+from array import array
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from time import strftime, gmtime
+from exifparse import BATCH_SIZE, commandBatches, parseExifTime, readTimestamp, readTimestampsExiv2
+from exiftool import ExifToolPool
+from exifwrite import writeGPS
+from gpsfuncs import decToDMS, formatAsRational, normalToLatLon, Trackpoint
+from gpxparse import expandFilenames, loadTracks
+from trackcache import defaultDirectory
+from tracklib import TrackLibrary, isTrackLibrary
+from trackstore import CompactTrack, mergeTracks
 from xml.dom.minidom import getDOMImplementation
 # PyXML's PrettyPrint looks nicer than toprettyxml; try to import it
 try:
     from xml.dom.ext import PrettyPrint
 except:
     None
+# with NumPy all photos can be matched in a few array operations
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Photo:
@@ -35,41 +47,230 @@ class Photo:
 
     pass
 
-def getExif(photo):
-    """Get the EXIF tags for a file as returned by exiv2.
+def chooseBackend(backend):
+    """Return the tool to read and write EXIF data with: backend unless it
+       is auto, otherwise exiv2 if it is installed and exiftool if only that is.
     """
-    stdout = subprocess.Popen(["exiv2","pr",photo.filename],stdout=subprocess.PIPE).communicate()[0];
-    return dict( (items[0].strip(),items[1].strip()) for items in [line.split(b':',1) for line in stdout.split(b'\n')] if len(items)==2)
-
-def setExif(photo):
+    if backend != "auto":
+        return backend
+    if shutil.which("exiv2") is None and shutil.which("exiftool") is not None:
+        return "exiftool"
+    return "exiv2"
+
+def positiveInt(value):
+    """Convert an option to an int of at least 1 for ArgumentParser.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError("must be a number of at least 1: %s" % value)
+    return number
+
+def poolSize(jobs):
+    """Return jobs, or by default as many threads as a ThreadPoolExecutor
+       has, which suits threads that mostly wait for files and processes.
+    """
+    return jobs or min(32, (os.cpu_count() or 1) + 4)
+
+def getTimestamps(photos, jobs=None, exiftool=None):
+    """Return the EXIF timestamps of photos, see readTimestamp, in a list
+       parallel to photos with an exception for the photos without one.
+
+       JPEG and TIFF files are read directly; exiv2 is only run, once for
+       many files, for the photos that cannot be read that way. With
+       exiftool, an ExifToolPool, its processes read them instead. Both
+       happen on a pool of jobs threads (by default a few more than there
+       are CPUs), so that several files or processes are being read at any
+       time.
+    """
+    def readExifTool(filename):
+        try:
+            with exiftool.borrow() as tool:
+                return tool.readTimestamp(filename)
+        except Exception as error:
+            return error
+
+    def readBatch(filenames):
+        if exiftool is not None:
+            return [readExifTool(filename) for filename in filenames]
+        try:
+            return readTimestampsExiv2(filenames)
+        except OSError as error:
+            # exiv2 could not be run at all
+            return [error] * len(filenames)
+
+    jobs = poolSize(jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        timestamps = list(pool.map(readTimestamp, [photo.filename for photo in photos]))
+        missing = [photos[i].filename for (i, timestamp) in enumerate(timestamps) if timestamp is None]
+        # give every thread a batch of its own
+        size = min(BATCH_SIZE, -(-len(missing) // jobs)) or 1
+        batches = pool.map(readBatch, [missing[i:i+size] for i in range(0, len(missing), size)])
+        missing = iter(timestamp for batch in batches for timestamp in batch)
+        timestamps = [next(missing) if timestamp is None else timestamp for timestamp in timestamps]
+    return [ValueError("no EXIF timestamp") if timestamp is None else timestamp for timestamp in timestamps]
+
+def setExif(photo, exiftool=None):
     """Set the EXIF tags on this photo.
 
        photo is a Photo type containing trackpoint information and the
-       filename of the .jpg file to be operated on.
+       filename of the .jpg file to be operated on. The tags are written
+       with exiv2, or with exiftool if given an ExifToolPool.
 
        In addition to writing the GPSInfo EXIF tags, an EXIF comment
        is written with the same information.
     """
-
+    if exiftool is not None:
+        with exiftool.borrow() as tool:
+            tool.writeTags(photo.filename, [
+                ("EXIF:UserComment", photo.trackpoint.getstr()),
+                ("GPSVersionID", "2 2 0 0"),
+                ("GPSLatitudeRef", ("N", "S")[photo.trackpoint.lat < 0]),
+                ("GPSLatitude", repr(abs(photo.trackpoint.lat))),
+                ("GPSAltitudeRef#", (0, 1)[photo.trackpoint.ele < 0]),
+                ("GPSAltitude", repr(abs(photo.trackpoint.ele))),
+                ("GPSMapDatum", "WGS-84"),
+                ("GPSLongitudeRef", ("E", "W")[photo.trackpoint.lon < 0]),
+                ("GPSLongitude", repr(abs(photo.trackpoint.lon)))])
+        return
+
+    arguments = ["exiv2","-k"]
+    for command in exiv2Commands(photo.trackpoint):
+        arguments += ["-M", command]
+    subprocess.check_call(arguments + [photo.filename])
+
+def exiv2Commands(trackpoint):
+    """Return the exiv2 modify commands (see exiv2 -M) that set the EXIF tags of setExif for trackpoint.
+    """
     # poor man's ? operator
-    latref = ("N", "S")[photo.trackpoint.lat < 0]
-    latdeg, latmin, latsec = [formatAsRational(deg) for deg in decToDMS(abs(photo.trackpoint.lat))]
-    lonref = ("E", "W")[photo.trackpoint.lon < 0]
-    londeg, lonmin, lonsec = [formatAsRational(deg) for deg in decToDMS(abs(photo.trackpoint.lon))]
-    altref = (0, 1)[photo.trackpoint.ele < 0]
-    alt = formatAsRational(abs(photo.trackpoint.ele))
-
-    subprocess.check_call(["exiv2","-k",
-        "-M","set Exif.Photo.UserComment charset=Ascii %s"%photo.trackpoint.getstr(),
-        "-M","set Exif.GPSInfo.GPSVersionID 2 2 0 0",
-        "-M","set Exif.GPSInfo.GPSLatitudeRef %s"%latref,
-        "-M","set Exif.GPSInfo.GPSLatitude %s %s %s"%(latdeg,latmin,latsec),
-        "-M","set Exif.GPSInfo.GPSAltitudeRef %s"%altref,
-        "-M","set Exif.GPSInfo.GPSAltitude %s"%alt,
-        "-M","set Exif.GPSInfo.GPSMapDatum WGS-84",
-        "-M","set Exif.GPSInfo.GPSLongitudeRef %s"%lonref,
-        "-M","set Exif.GPSInfo.GPSLongitude %s %s %s"%(londeg,lonmin,lonsec),
-        photo.filename])
+    latref = ("N", "S")[trackpoint.lat < 0]
+    latdeg, latmin, latsec = [formatAsRational(deg) for deg in decToDMS(abs(trackpoint.lat))]
+    lonref = ("E", "W")[trackpoint.lon < 0]
+    londeg, lonmin, lonsec = [formatAsRational(deg) for deg in decToDMS(abs(trackpoint.lon))]
+    altref = (0, 1)[trackpoint.ele < 0]
+    alt = formatAsRational(abs(trackpoint.ele))
+
+    return ["set Exif.Photo.UserComment charset=Ascii %s"%trackpoint.getstr(),
+        "set Exif.GPSInfo.GPSVersionID 2 2 0 0",
+        "set Exif.GPSInfo.GPSLatitudeRef %s"%latref,
+        "set Exif.GPSInfo.GPSLatitude %s %s %s"%(latdeg,latmin,latsec),
+        "set Exif.GPSInfo.GPSAltitudeRef %s"%altref,
+        "set Exif.GPSInfo.GPSAltitude %s"%alt,
+        "set Exif.GPSInfo.GPSMapDatum WGS-84",
+        "set Exif.GPSInfo.GPSLongitudeRef %s"%lonref,
+        "set Exif.GPSInfo.GPSLongitude %s %s %s"%(londeg,lonmin,lonsec)]
+
+def photoDevice(photo):
+    """Return the device a photo is stored on, or None if it cannot be told.
+    """
+    try:
+        return os.stat(photo.filename).st_dev
+    except OSError:
+        return None
+
+def writeExif(photos, exiftool=None, jobs=None, perDevice=2, report=None, native=True):
+    """Set the EXIF tags of setExif on all photos; return a list parallel to
+       photos with None for the photos written and the exception for the
+       others.
+
+       The photos are written by a pool of jobs threads (by default a few
+       more than there are CPUs). Unless native is False, JPEG and TIFF
+       files are written directly where writeGPS can; for the others each
+       thread runs an exiv2 process or borrows an exiftool process from
+       exiftool, an ExifToolPool. At most perDevice writes go to the same
+       device at any time so that a disk does not have to seek between too
+       many files. report(photo, error) is called as soon as a photo is done.
+
+       exiv2 applies the commands of a command file (see exiv2 -m) to all
+       files it is given, so photos on the same device that get the same
+       tags, such as those matched to the same trackpoint, are written by a
+       single exiv2 process. If such a batch fails, it is written again in
+       halves to find out which of its photos failed, so that a single bad
+       photo costs a few processes rather than one for every photo.
+    """
+    errors = [None] * len(photos)
+    def write(i):
+        try:
+            setExif(photos[i], exiftool)
+        except Exception as error:
+            errors[i] = error
+
+    def writeBatch(commands, indexes):
+        with tempfile.NamedTemporaryFile("w", suffix=".exv-commands") as commandFile:
+            commandFile.write("".join(command + "\n" for command in commands))
+            commandFile.flush()
+            pending = [indexes]
+            while pending:
+                indexes = pending.pop()
+                # names that look like options are made relative, see readTimestampsExiv2
+                names = [os.path.join(".", photos[i].filename) if photos[i].filename.startswith("-") else photos[i].filename
+                         for i in indexes]
+                arguments = ["exiv2", "-k", "-m", commandFile.name] + names
+                try:
+                    if len(indexes) == 1:
+                        subprocess.check_call(arguments)
+                    elif subprocess.call(arguments, stderr=subprocess.DEVNULL) != 0:
+                        # find the photos that failed by halves
+                        pending += [indexes[len(indexes)//2:], indexes[:len(indexes)//2]]
+                except OSError as error:
+                    # exiv2 could not be run at all
+                    for i in indexes:
+                        errors[i] = error
+                except subprocess.CalledProcessError as error:
+                    errors[indexes[0]] = error
+
+    devices = [photoDevice(photo) for photo in photos]
+    writing = dict((device, threading.Semaphore(perDevice)) for device in set(devices))
+    def writeNative(i):
+        with writing[devices[i]]:
+            try:
+                if not writeGPS(photos[i].filename, photos[i].trackpoint):
+                    return False
+            except Exception as error:
+                errors[i] = error
+        if report is not None:
+            report(photos[i], errors[i])
+        return True
+
+    def run(task):
+        device, commands, indexes = task
+        with writing[device]:
+            if commands is None:
+                write(indexes[0])
+            else:
+                writeBatch(commands, indexes)
+        if report is not None:
+            for i in indexes:
+                report(photos[i], errors[i])
+
+    with ThreadPoolExecutor(max_workers=poolSize(jobs)) as pool:
+        remaining = range(len(photos))
+        if native:
+            remaining = [i for (i, written) in enumerate(pool.map(writeNative, remaining)) if not written]
+
+        # the tasks, each writing some photos on a single device
+        tasks = []
+        if exiftool is not None:
+            tasks = [(devices[i], None, [i]) for i in remaining]
+        else:
+            batches = {}
+            for i in remaining:
+                batches.setdefault((devices[i], tuple(exiv2Commands(photos[i].trackpoint))), []).append(i)
+            for ((device, commands), indexes) in batches.items():
+                if len(indexes) == 1:
+                    tasks.append((device, None, indexes))
+                    continue
+                # the longest command line the command file could need
+                command = ["exiv2", "-k", "-m", os.path.join(tempfile.gettempdir(), "x"*64)]
+                for batch in commandBatches(command, [photos[i].filename for i in indexes]):
+                    tasks.append((device, commands, indexes[:len(batch)]))
+                    indexes = indexes[len(batch):]
+
+        # the largest batches first, so that they do not hold up the end
+        list(pool.map(run, sorted(tasks, key=lambda task: -len(task[2]))))
+    return errors
 
 def interpolate_n(deltas, values):
     """For values[0]=f(x0), values[1]=f(x1), do linear interpolation to find f(x) with |x-x0|=deltas[0], |x-x1|=deltas[1].
@@ -81,103 +282,237 @@ def interpolate_n(deltas, values):
         weights = [1/delta for delta in deltas]
     return sum([value*weight for (value,weight) in zip(values,weights)])/sum(weights)
 
-def findNearestTrackpoint(list, time, interpolate, threshold):
-    """Search the list of trackpoints, and return the one with the time nearest to time possibly interpolating between closest trackpoints
+def findNearestTrackpoint(track, time, interpolate, threshold, maxGap=float("inf")):
+    """Search the track (a TrackStore), and return the trackpoint with the time nearest to time possibly interpolating between closest trackpoints
 
-       Return None if no trackpoint exists within threshold seconds
+       Return None if no trackpoint exists within threshold seconds. There
+       is no interpolation between the segments of the track or across a
+       gap of more than maxGap seconds; the nearest trackpoint is taken
+       instead.
+    """
+    # the track is sorted by time, so the closest point after is the first
+    # one not before time and the closest point before is the first one
+    # carrying the latest time before time
+    after = track.searchTime(time)
+    before = None
+    if after > 0:
+        before = track.searchTime(track.time[after-1])
+    return trackpointBetween(track, time, before, after, interpolate, threshold, maxGap)
+
+def trackpointBetween(track, time, before, after, interpolate, threshold, maxGap=float("inf")):
+    """Return the trackpoint for time given the indexes of its closest trackpoints in the track, see findNearestTrackpoint.
+
+       before is the index of the first trackpoint with the latest time
+       before time or None, after the index of the first trackpoint not
+       before time or len(track).
     """
-    closestPoints = [None, None] # the closest point before and after
-    closestTimes = [threshold, threshold]  # Python datetimes are seconds
-    # iterate over the list (binary search would work too)
-    for trackpoint in list:
-        delta = trackpoint.time - time
-        after = (delta >= 0)
-        # if this point is closer than the closest recorded yet
-        if abs(delta) < closestTimes[after]:
-            closestTimes[after] = abs(delta)
-            closestPoints[after] = trackpoint
+    closestPoints = [None, None] # the indexes of the closest point before and after
+    if before is not None and time - track.time[before] < threshold:
+        closestPoints[0] = before
+    if after < len(track) and track.time[after] - time < threshold:
+        closestPoints[1] = after
 
     for i in [0,1]:
         if closestPoints[i] is None: closestPoints[i] = closestPoints[1-i]
-    #if both are None then there had been no points at all and we're screwed
-
-    #reduce the !interpolate case to the interpolate case
-    if not interpolate:
+    #if both are None then there are no points within threshold
+    if closestPoints[0] is None:
+        return None
+
+    #reduce the !interpolate case to the interpolate case; so are times
+    #between two segments of the track or in a gap longer than maxGap
+    if not interpolate or (closestPoints[0] != closestPoints[1] and
+            (track.segmentOf(closestPoints[0]) != track.segmentOf(closestPoints[1])
+             or track.time[closestPoints[1]] - track.time[closestPoints[0]] > maxGap)):
         for i in [0,1]:
-            if abs(closestPoints[i].time - time)<=abs(closestPoints[1-i].time-time):
+            if abs(track.time[closestPoints[i]] - time)<=abs(track.time[closestPoints[1-i]]-time):
                 closestPoints[1-i]=closestPoints[i]
 
-    #we use normal vectors for interpolation purposes (http://en.wikipedia.org/wiki/N-vector)
-    normals = [ (cos(point.lat/90.*pi)*cos(point.lon/90.*pi),
-                cos(point.lat/90.*pi)*sin(point.lon/90.*pi),
-                sin(point.lat/90.*pi)) for point in closestPoints ]
-    deltas = [ abs(time-point.time) for point in closestPoints ]
-    #interpolate the normal vectors
-    normal = [ interpolate_n(deltas, values) for values in zip(*normals) ]
-    #normalize the result
-    normal = [ value/sum(v*v for v in normal) for value in normal ]
-    #interpolate the elevation
-    elevation = interpolate_n(deltas, (closestPoints[0].ele, closestPoints[1].ele))
-
-    #convert everything back to lat/lon coordinates
-    ret = Trackpoint(
-            atan2(normal[2],sqrt(normal[0]**2+normal[1]**2))/pi*90,
-            atan2(normal[1],normal[0])/pi*90,
-            elevation);
-    ret.time = time
-    return ret
+    #we use normal vectors for interpolation purposes (http://en.wikipedia.org/wiki/N-vector);
+    #the track keeps them precomputed
+    if track.slopes is not None and closestPoints[0] != closestPoints[1]:
+        #the track tabulates the interpolation between before and after
+        offset = time - track.time[after]
+        normal = [ column[after] + slope[after]*offset for (column, slope) in zip((track.x, track.y, track.z), track.slopes) ]
+        elevation = track.ele[after] + track.slopes[3][after]*offset
+    else:
+        normals = [ (track.x[i], track.y[i], track.z[i]) for i in closestPoints ]
+        deltas = [ abs(time-track.time[i]) for i in closestPoints ]
+        #interpolate the normal vectors
+        normal = [ interpolate_n(deltas, values) for values in zip(*normals) ]
+        #interpolate the elevation
+        elevation = interpolate_n(deltas, [track.ele[i] for i in closestPoints])
+
+    #convert everything back to lat/lon coordinates; this takes care of
+    #normalizing the interpolated vector
+    lat, lon = normalToLatLon(*normal)
+    return Trackpoint(lat, lon, float(elevation), time)
+
+def sweepTrackpoints(track, times, interpolate, threshold, maxGap=float("inf")):
+    """Match a whole sequence of times against the track in a single pass, see findNearestTrackpoints.
+
+       The times are visited in chronological order while walking along
+       the track, so all times cost O(len(track) + len(times)) altogether
+       instead of a binary search per time. A track with a time index (see
+       TrackStore.indexTime) is not walked; its index finds every time.
+       Returns the same columns as findNearestTrackpoints without NumPy,
+       parallel to times.
+    """
+    nan = float("nan")
+    lat, lon, ele = array('d', [nan])*len(times), array('d', [nan])*len(times), array('d', [nan])*len(times)
+    matched = [False]*len(times)
+    trackTimes = track.time
+    # after walks along the track; before is the first index carrying the
+    # latest time that after has passed
+    before, after = None, 0
+    for i in sorted(range(len(times)), key=times.__getitem__):
+        time = times[i]
+        if track.timeIndex is not None:
+            after = track.timeIndex.search(time)
+            before = track.timeIndex.search(trackTimes[after-1]) if after else None
+        while after < len(trackTimes) and trackTimes[after] < time:
+            if before is None or trackTimes[after] != trackTimes[before]:
+                before = after
+            after += 1
+        point = trackpointBetween(track, time, before, after, interpolate, threshold, maxGap)
+        if point is not None:
+            lat[i], lon[i], ele[i], matched[i] = point.lat, point.lon, point.ele, True
+    return lat, lon, ele, matched
+
+def findNearestTrackpoints(track, times, interpolate, threshold, maxGap=float("inf")):
+    """Match a whole sequence of times against the track at once, see findNearestTrackpoint.
+
+       Return a tuple (lat, lon, ele, matched) of columns parallel to
+       times; matched[i] tells whether times[i] had a trackpoint within
+       threshold seconds, the coordinates of the others are NaN. The
+       columns are NumPy arrays if NumPy is available and the track keeps
+       its columns in NumPy arrays; otherwise they are arrays of doubles and
+       a list of bools, computed one time at a time.
+    """
+    if numpy is None or not isinstance(track.time, numpy.ndarray):
+        lat, lon, ele, matched = array('d'), array('d'), array('d'), []
+        for time in times:
+            point = findNearestTrackpoint(track, time, interpolate, threshold, maxGap)
+            matched.append(point is not None)
+            if point is None:
+                point = Trackpoint(float("nan"), float("nan"), float("nan"))
+            lat.append(point.lat)
+            lon.append(point.lon)
+            ele.append(point.ele)
+        return lat, lon, ele, matched
+
+    times = numpy.asarray(times, dtype=numpy.float64)
+    nan = numpy.full(len(times), numpy.nan)
+    if len(track) == 0:
+        return nan, nan.copy(), nan.copy(), numpy.zeros(len(times), dtype=bool)
+
+    # the same bracketing as in findNearestTrackpoint, for all times at once
+    if track.timeIndex is not None:
+        search = track.timeIndex.searchAll
+    else:
+        search = lambda values: numpy.searchsorted(track.time, values, "left")
+    after = search(times)
+    hasBefore, hasAfter = after > 0, after < len(track)
+    before = search(track.time[numpy.maximum(after - 1, 0)])
+    after = numpy.minimum(after, len(track) - 1)
+    hasBefore &= times - track.time[before] < threshold
+    hasAfter &= track.time[after] - times < threshold
+    matched = hasBefore | hasAfter
+    before, after = numpy.where(hasBefore, before, after), numpy.where(hasAfter, after, before)
+
+    deltas = [numpy.abs(times - track.time[before]), numpy.abs(times - track.time[after])]
+    #reduce the !interpolate case to the interpolate case; so are times
+    #between two segments of the track or in a gap longer than maxGap
+    single = True
+    if interpolate:
+        segments = numpy.asarray(track.segments)
+        single = (numpy.searchsorted(segments, before, "right") != numpy.searchsorted(segments, after, "right")) \
+                 | (track.time[after] - track.time[before] > maxGap)
+    nearest = numpy.where(deltas[0] <= deltas[1], before, after)
+    before, after = numpy.where(single, nearest, before), numpy.where(single, nearest, after)
+    deltas = [numpy.abs(times - track.time[before]), numpy.abs(times - track.time[after])]
+
+    if track.slopes is not None:
+        #the track tabulates the interpolation between before and after
+        offset = numpy.where(before != after, times - track.time[after], 0)
+        normal = [ column[after] + slope[after]*offset for (column, slope) in zip((track.x, track.y, track.z), track.slopes) ]
+        elevation = track.ele[after] + track.slopes[3][after]*offset
+    else:
+        #interpolate the normal vectors and the elevation (see interpolate_n)
+        exact = (deltas[0] == 0) | (deltas[1] == 0)
+        with numpy.errstate(divide="ignore"):
+            weights = [numpy.where(exact, delta == 0, 1/delta) for delta in deltas]
+        def interpolate_columns(values):
+            return (values[0]*weights[0] + values[1]*weights[1])/(weights[0] + weights[1])
+        normal = [ interpolate_columns([column[before], column[after]]) for column in (track.x, track.y, track.z) ]
+        elevation = interpolate_columns([track.ele[before], track.ele[after]])
+
+    lat = numpy.where(matched, numpy.degrees(numpy.arctan2(normal[2], numpy.sqrt(normal[0]*normal[0] + normal[1]*normal[1]))), nan)
+    lon = numpy.where(matched, numpy.degrees(numpy.arctan2(normal[1], normal[0])), nan)
+    ele = numpy.where(matched, elevation, nan)
+    return lat, lon, ele, matched
 
 def main():
     # Parse the options
     parser = ArgumentParser()
     parser.add_argument("args", metavar="PHOTO", nargs='*', help='photos to be processed')
-    parser.add_argument("-g", "--gps", dest="gps", required=True,
-                      help="The input GPS track file in .gpx format", metavar="FILE")
+    parser.add_argument("-g", "--gps", dest="gps", action="append", default=[],
+                      help="The input GPS track file in .gpx format or a tracklog library; may be given several times and may contain wildcards", metavar="FILE")
+    parser.add_argument("-l", "--library", dest="library",
+                      help="add the GPX files to this tracklog library (unless they are there already) and match the photos against the whole library", metavar="FILE")
     parser.add_argument("-p", "--photos", dest="photos",
                       help="The directory of photos", metavar="DIR")
     # MPickering added next option; this offset is added to the JPG values (which don't have
     # native timezone information)
-    parser.add_argument("-t", "--timediff", dest="timediff", type=int, default=0,
-                      help="Add this number of hours to the JPEG times")
+    parser.add_argument("-t", "--timediff", dest="timediff", type=int, default=None,
+                      help="Add this number of hours to the JPEG times; by default the UTC offset recorded in a JPEG, if any, is subtracted")
     parser.add_argument("-o", "--output", dest="output",
                       help="The output filename for the GPX file", metavar="FILE")
     parser.add_argument("-u", "--update-photos", action="store_true",
                       dest="updatephotos", help="Update the photos with GPS information")
     parser.add_argument("-v", "--verbose",
-                      action="store_true", dest="verbose")  # not used; could be useful
+                      action="store_true", dest="verbose", help="report every photo that has been updated")
+    parser.add_argument("--no-native-write", action="store_false", dest="nativewrite",
+                      help="with --update-photos, write all photos with the backend rather than JPEG and TIFF files directly")
+    parser.add_argument("--writes-per-device", dest="perdevice", type=positiveInt, default=2,
+                      help="with --update-photos, how many photos to write at the same time on each disk (default: %(default)s)", metavar="N")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=positiveInt, default=None,
+                      help="how many photos to read, and with --update-photos to write, at the same time (default: a few more than there are CPUs)")
+    parser.add_argument("--backend", dest="backend", choices=("auto", "exiv2", "exiftool"), default="auto",
+                      help="the tool to read and write EXIF data with where geotag cannot do it itself; exiftool is kept running for all photos (default: exiv2 if it is installed)")
     parser.add_argument("-i", "--interpolate", action="store_true", dest="interpolate",
                       help="interpolate coordinates linearily between closest track points")
+    parser.add_argument("--match", dest="match", choices=("batch", "sweep"), default="batch",
+                      help="how to match photos against the track: all at once with a binary search per photo (batch), or in a single pass along the track with the photos sorted by time (sweep)")
     parser.add_argument("--threshold", dest="threshold", type=int, default=5*60,
                       help="threshold in seconds that a track point may differ from a photos timestamp still allowing them to get associated; set to -1 to allow arbitrary threshold.")
+    parser.add_argument("--max-gap", dest="maxgap", type=float, default=float("inf"),
+                      help="with --interpolate, take the closest track point rather than interpolate between track points more than this many seconds apart; there is never any interpolation between the segments of a track", metavar="SECONDS")
+    parser.add_argument("--near-photos", action="store_true", dest="nearphotos",
+                      help="only load the trackpoints of GPX files that lie within the threshold of the photos' times")
+    parser.add_argument("--sorted-gps", action="store_true", dest="sortedgps",
+                      help="the GPX files are sorted by time; with --near-photos, stop reading them after the photos' times")
+    parser.add_argument("--fast-gpx", action="store_true", dest="fastgpx",
+                      help="scan GPX files for trackpoints without a full XML parser where they allow it")
+    parser.add_argument("--time-index", action="store_true", dest="timeindex",
+                      help="index the track by time buckets, so that the photos are matched without a binary search each, and --match sweep jumps along the track instead of walking it; pays off for regularly sampled tracks and many photos")
+    parser.add_argument("--segment-table", action="store_true", dest="segmenttable",
+                      help="with --interpolate, precompute the interpolation between consecutive trackpoints; pays off for many photos")
+    parser.add_argument("--compact", action="store_true", dest="compact",
+                      help="keep the track quantized in memory, with about 6 cm of precision, to save memory")
+    parser.add_argument("--cache-dir", dest="cachedir", default=defaultDirectory(),
+                      help="directory to cache parsed GPX files in (default: %(default)s)", metavar="DIR")
+    parser.add_argument("--no-cache", action="store_true", dest="nocache",
+                      help="neither read nor write the cache of parsed GPX files")
+    parser.add_argument("--rebuild-cache", action="store_true", dest="rebuildcache",
+                      help="parse the GPX files again and replace their cached copies")
     options = parser.parse_args()
     args = options.args
+    if not options.gps and not options.library:
+        parser.error("no GPS track given, use --gps or --library")
 
     if options.threshold==-1: options.threshold = float("inf")
 
-    # Load and Parse the GPX file to retrieve all the trackpoints
-    xmldoc = minidom.parse(options.gps)
-    gpx = xmldoc.getElementsByTagName("gpx")
-    # get all trackpoints, irrespective of their track
-    trackpointElements = gpx[0].getElementsByTagName("trkpt")
-
     photos = []
-    trackpoints = []
-
-    # Iterate over the trackpoints; put them in a list sorted by time
-    for pt in trackpointElements:
-        timeElement = pt.getElementsByTagName("time")
-        time = ""
-        if timeElement:
-            timeString = timeElement[0].firstChild.data
-            # times are in xsd:dateTime:  <time>2006-12-20T15:01:06Z</time>
-            time = mktime(strptime(timeString[0:len(timeString)-1], "%Y-%m-%dT%H:%M:%S"))
-            trackpoint = Trackpoint()
-            trackpoint.lat = float(pt.attributes["lat"].value)
-            trackpoint.lon = float(pt.attributes["lon"].value)
-            trackpoint.ele = float(pt.getElementsByTagName("ele")[0].firstChild.data)
-            trackpoint.time = time
-            trackpoints.append(trackpoint)
-    trackpoints.sort(key=lambda obj:obj.time)
 
     # prepare the list of photos
     if options.photos:
@@ -188,23 +523,84 @@ def main():
         photolist = args
     photolist.sort()
 
+    allPhotos = []
     for file in photolist:
         photo = Photo()
         photo.filename = file
         photo.shortfilename = os.path.split(file)[1]
-        # Parse the EXIF data and find the closest matching trackpoint
-        tags = getExif(photo)
+        allPhotos.append(photo)
+
+    timedPhotos, failures = [], []
+    exiftool = ExifToolPool() if chooseBackend(options.backend) == "exiftool" else None
+    for (photo, timestamp) in zip(allPhotos, getTimestamps(allPhotos, options.jobs, exiftool)):
         try:
-            photo.time = mktime(strptime(bytes.decode(tags[b'Image timestamp']), "%Y:%m:%d %H:%M:%S"))
-            # account for time difference (GPX uses UTC; EXIF uses local time)
-            photo.time += options.timediff * 3600
-            photo.trackpoint = findNearestTrackpoint(trackpoints, photo.time, options.interpolate, options.threshold)
-            if photo.trackpoint:
-                photos.append(photo)
-        except:
+            if isinstance(timestamp, Exception):
+                raise timestamp
+            # read the EXIF time like a UTC time, as the GPX times are
+            photo.time, offset = parseExifTime(*timestamp)
+        except Exception as error:
             # picture may have been unreadable, may not have had timestamp, etc.
-            print(photo.filename, traceback.format_exc())
-
+            failures.append((photo, error))
+            continue
+        # account for time difference (GPX uses UTC; EXIF uses local time)
+        if options.timediff is not None:
+            photo.time += options.timediff * 3600
+        elif offset is not None:
+            photo.time -= offset
+        timedPhotos.append(photo)
+    # to stderr, as the GPX file may go to stdout
+    for (photo, error) in failures:
+        sys.stderr.write("%s %s: %s\n" % (photo.filename, type(error).__name__, error))
+
+    # Load the trackpoints of the GPX files; the track is sorted by time
+    filenames = expandFilenames(options.gps)
+    libraries = [TrackLibrary(filename) for filename in filenames if isTrackLibrary(filename)]
+    filenames = [filename for filename in filenames if not isTrackLibrary(filename)]
+    if options.library:
+        library = TrackLibrary(options.library)
+        for filename in filenames:
+            library.ingest(filename)
+        libraries.append(library)
+        filenames = []
+    # only the part of the track around the photos is needed
+    window = (float("inf"), float("-inf"))
+    if timedPhotos:
+        window = (min(photo.time for photo in timedPhotos) - options.threshold,
+                  max(photo.time for photo in timedPhotos) + options.threshold)
+    tracks = []
+    if filenames:
+        tracks.append(loadTracks(filenames,
+            cacheDirectory=None if options.nocache else options.cachedir, rebuildCache=options.rebuildcache,
+            window=window if options.nearphotos else None, ordered=options.sortedgps, fast=options.fastgpx))
+    if timedPhotos:
+        tracks.extend(library.loadRange(*window) for library in libraries)
+    track = mergeTracks(tracks) if len(tracks) != 1 else tracks[0]
+    if options.compact:
+        track = CompactTrack(track)
+    else:
+        if options.timeindex:
+            track.indexTime()
+        if options.segmenttable and options.interpolate:
+            track.tabulateSegments()
+
+    # find the closest matching trackpoints for all photos at once
+    match = (findNearestTrackpoints, sweepTrackpoints)[options.match == "sweep"]
+    lats, lons, eles, matched = match(track, [photo.time for photo in timedPhotos], options.interpolate, options.threshold, options.maxgap)
+    for (i, photo) in enumerate(timedPhotos):
+        if matched[i]:
+            photo.trackpoint = Trackpoint(float(lats[i]), float(lons[i]), float(eles[i]), photo.time)
+            photos.append(photo)
+
+    # write the tags to the photos in the background while the GPX file is
+    # generated; the reports go to stderr as the GPX file may go to stdout
+    if options.updatephotos:
+        def reportWrite(photo, error):
+            if error is not None:
+                sys.stderr.write("%s %s: %s\n" % (photo.filename, type(error).__name__, error))
+            elif options.verbose:
+                sys.stderr.write("%s written\n" % photo.filename)
+        writer = ThreadPoolExecutor(max_workers=1)
+        writing = writer.submit(writeExif, photos, exiftool, options.jobs, options.perdevice, reportWrite, options.nativewrite)
 
     # ready to output the photo listing
     impl = getDOMImplementation()
@@ -275,10 +671,6 @@ def main():
         wpt_element.appendChild(desc_element)
         desc_element.appendChild(gpxdoc.createTextNode(photo.shortfilename))
 
-        # now, assemble and execute the exiv2 command
-        if options.updatephotos:
-            setExif(photo);
-
     # finish the bounds element
     bounds_element.setAttribute("minlat", str(minlat))
     bounds_element.setAttribute("minlon", str(minlon))
@@ -298,6 +690,13 @@ def main():
 
     outfile.close()
 
+    # wait for the photos to be written
+    if options.updatephotos:
+        writing.result()
+        writer.shutdown()
+    if exiftool is not None:
+        exiftool.close()
+
 
 if __name__ == "__main__":
     main()
@@ -3,12 +3,17 @@
 # A few classes and functions for handling GPS data and photos
 #
 
+from math import radians, degrees, sin, cos, atan2, sqrt
+
 class Trackpoint:
     """A simple holder class for the trackpoint data"""
-    def __init__(self, lat = 0.0, lon=0.0, ele=0.0):
+    __slots__ = ("lat", "lon", "ele", "time")
+
+    def __init__(self, lat = 0.0, lon=0.0, ele=0.0, time=None):
         self.lat = lat
         self.lon = lon
         self.ele = ele
+        self.time = time
 
     def __repr__(self): 
         return "[%d,%s,%s,%s]" % (self.time, str(self.lon), str(self.lat), str(self.ele))
@@ -19,6 +24,32 @@ class Trackpoint:
     pass
 
 
+def latLonToNormal(lat, lon):
+    """Convert a position in decimal degrees to its n-vector, the unit normal
+       vector (x, y, z) of the earth's surface at that position
+       (http://en.wikipedia.org/wiki/N-vector)
+
+       >>> [round(value, 12) for value in latLonToNormal(0, 90)]
+       [0.0, 1.0, 0.0]
+       >>> [round(value, 12) for value in latLonToNormal(-45, 180)]
+       [-0.707106781187, 0.0, -0.707106781187]
+    """
+    lat, lon = radians(lat), radians(lon)
+    return (cos(lat)*cos(lon), cos(lat)*sin(lon), sin(lat))
+
+
+def normalToLatLon(x, y, z):
+    """Convert a normal vector (x, y, z), not necessarily of unit length, back
+       to a position (lat, lon) in decimal degrees
+
+       >>> [round(value, 9) for value in normalToLatLon(0, 0, 2)]
+       [90.0, 0.0]
+       >>> [round(value, 9) for value in normalToLatLon(1, -1, 0)]
+       [0.0, -45.0]
+    """
+    return (degrees(atan2(z, sqrt(x*x + y*y))), degrees(atan2(y, x)))
+
+
 def decToDMS(degrees):
     """Convert a decimal degree measurement into degrees, minutes, and seconds
        Works on positive degrees only!  Handle E/W outside this function!
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+#
+# Reading trackpoints from GPX files
+#
+
+import os, re
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache, partial
+from glob import glob
+from math import floor, ceil
+from mmap import mmap, ACCESS_READ
+from time import strftime, gmtime
+from xml.etree.ElementTree import iterparse
+from trackstore import TrackStore, concatTracks, mergeTracks, segmentSpans
+from trackcache import lookupTrack, storeTrack
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def localName(tag):
+    """Strip the namespace from an ElementTree tag,
+       e.g. {http://www.topografix.com/GPX/1/1}trkpt -> trkpt
+    """
+    return tag.rsplit('}', 1)[-1]
+
+@lru_cache(maxsize=1024)
+def parseDate(dateString):
+    """Convert an xsd:date such as 2006-12-20 to the seconds from the epoch to its midnight (UTC).
+    """
+    year, month, day = dateString.split('-')
+    return (date(int(year), int(month), int(day)).toordinal() - EPOCH) * 86400
+
+def parseTime(timeString):
+    """Convert an xsd:dateTime such as 2006-12-20T15:01:06Z to seconds since the epoch.
+
+       Fractional seconds and offsets such as 2006-12-20T16:01:06.5+01:00 are
+       understood; times without an offset are taken to be UTC. The date part
+       is cached since consecutive trackpoints mostly share it.
+    """
+    dateString, t, clock = timeString.partition('T')
+    offset = 0
+    if clock.endswith('Z'):
+        clock = clock[:-1]
+    elif len(clock) > 8 and clock[-6] in "+-" and clock[-3] == ':':
+        offset = int(clock[-5:-3])*3600 + int(clock[-2:])*60
+        if clock[-6] == '-':
+            offset = -offset
+        clock = clock[:-6]
+    if not t or len(clock) < 8 or clock[2] != ':' or clock[5] != ':':
+        raise ValueError("not an xsd:dateTime: %r" % timeString)
+    seconds = parseDate(dateString) + int(clock[0:2])*3600 + int(clock[3:5])*60 - offset
+    if len(clock) == 8:
+        return float(seconds + int(clock[6:8]))
+    return seconds + float(clock[6:])
+
+# the magic bytes of compressed files and the modules to decompress them with
+COMPRESSIONS = [(b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "lzma")]
+
+def openTrackFile(filename):
+    """Open a GPX file for reading as bytes, decompressing it on the fly if it
+       is compressed with gzip, bzip2 or xz (recognized by its contents, not
+       by its name).
+    """
+    file = open(filename, "rb")
+    magic = file.peek(8)[:8]
+    for (prefix, module) in COMPRESSIONS:
+        if magic.startswith(prefix):
+            file.close()
+            return __import__(module).open(filename, "rb")
+    return file
+
+def timeWindow(start, end):
+    """Return a function telling whether an xsd:dateTime lies before (-1),
+       within (0) or after (1) the time span from start to end (seconds since
+       the epoch, possibly infinite).
+
+       UTC times (ending in Z) are compared as strings against the whole
+       seconds around the span without converting them, which lets times up
+       to a second outside the span through.
+    """
+    def bound(seconds, rounding):
+        if seconds == float("inf"):
+            return "~"
+        if seconds == float("-inf"):
+            return ""
+        return strftime("%Y-%m-%dT%H:%M:%S", gmtime(rounding(seconds)))
+    first, last = bound(start, floor), bound(end, ceil)
+    def position(timeString):
+        if len(timeString) >= 20 and timeString[19] in "Z." and timeString.endswith("Z"):
+            second = timeString[:19]
+            return -1 if second < first else int(second > last)
+        time = parseTime(timeString)
+        return -1 if time < start else int(time > end)
+    return position
+
+def iterTrackpointValues(source, window=None, ordered=False, segments=False):
+    """Iterate over all the trackpoints of a GPX file, irrespective of their track.
+
+       source is a filename (see openTrackFile) or a file object. The file
+       is parsed incrementally and every <trkpt> is discarded once its
+       values have been read, so the XML tree is never held in memory as a
+       whole.
+       Yields a (time, lat, lon, ele) tuple per trackpoint in file order;
+       trackpoints without a <time> are skipped.
+
+       With a window (start, end), only the trackpoints in that time span
+       (see timeWindow) are converted and yielded. If the file is known to
+       be ordered by time, reading stops at the first trackpoint after it.
+
+       With segments, None is yielded at the start of every <trkseg>.
+    """
+    if isinstance(source, str):
+        with openTrackFile(source) as file:
+            for values in iterTrackpointValues(file, window, ordered, segments):
+                yield values
+        return
+    position = timeWindow(*window) if window is not None else None
+    stack = []
+    for event, element in iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append(element)
+            if segments and localName(element.tag) == "trkseg":
+                yield None
+            continue
+        stack.pop()
+        name = localName(element.tag)
+        if name == "trkpt":
+            time = ele = None
+            for child in element:
+                childName = localName(child.tag)
+                if childName == "time" and child.text:
+                    time = child.text.strip()
+                elif childName == "ele" and child.text:
+                    ele = child.text
+            if time:
+                where = position(time) if position is not None else 0
+                if where == 0:
+                    yield (parseTime(time), float(element.get("lat")), float(element.get("lon")), float(ele) if ele else 0.0)
+                elif where > 0 and ordered:
+                    return
+        elif len(stack) != 1:
+            # the children of a <trkpt> are needed when it ends; anything
+            # else goes away together with its top-level ancestor
+            continue
+        # drop what we have seen; the parser still holds the open ancestors
+        element.clear()
+        if stack:
+            stack[-1].remove(element)
+
+def loadTrack(source, window=None, ordered=False, fast=False):
+    """Load all the trackpoints of a GPX file (within window, see iterTrackpointValues) into a TrackStore.
+
+       With fast, a file given by name is first tried with loadTrackFast.
+    """
+    if fast and isinstance(source, str):
+        track = loadTrackFast(source, window, ordered)
+        if track is not None:
+            return track
+    times, lats, lons, eles = array('d'), array('d'), array('d'), array('d')
+    segments = array('q')
+    for values in iterTrackpointValues(source, window, ordered, segments=True):
+        if values is None:
+            segments.append(len(times))
+            continue
+        time, lat, lon, ele = values
+        times.append(time)
+        lats.append(lat)
+        lons.append(lon)
+        eles.append(ele)
+    return TrackStore(times, lats, lons, eles, segments)
+
+# with the fast path, GPX files at least this large are scanned in parallel chunks
+CHUNKED_SIZE = 64 << 20
+# the fast path of loadTrack only understands plain machine-written GPX
+FAST_TRKPT = re.compile(rb"<trkpt\s([^>]*)>(.*?)</trkpt\s*>", re.S)
+FAST_LAT = re.compile(rb"\blat\s*=\s*[\"']([^\"']*)[\"']")
+FAST_LON = re.compile(rb"\blon\s*=\s*[\"']([^\"']*)[\"']")
+FAST_OPEN = re.compile(rb"<trkpt\b")
+FAST_TRKSEG = re.compile(rb"<trkseg\b")
+# the layout of most machine-written trackpoints, which can be read in bulk
+FAST_REGULAR = re.compile(rb"<trkpt\s+lat=\"([^\"]*)\"\s+lon=\"([^\"]*)\"\s*>\s*<ele>([^<]*)</ele>\s*<time>([^<]*)</time>\s*</trkpt\s*>")
+FAST_TIME = re.compile(rb"<time\s*>([^<]*)</time\s*>")
+FAST_ELE = re.compile(rb"<ele\s*>([^<]*)</ele\s*>")
+# anything that makes the fast path fall back to the XML parser: CDATA,
+# comments, entities, DTDs, namespace prefixes on the elements and attributes
+# it reads, empty <trkpt/> elements, and <time> and <ele> elements with
+# attributes or without content, which FAST_TIME and FAST_ELE do not match
+FAST_UNEXPECTED = re.compile(rb"<!\[CDATA\[|<!--|<!DOCTYPE|<!ENTITY|&|</?[\w.-]+:(?:trkpt|trkseg|time|ele)\b|:l(?:at|on)\s*=|<trkpt\b[^>]*/>|<(?:time|ele)(?:\s+[^\s>]|\s*/)")
+
+def mapTrackFile(filename):
+    """Memory-map a GPX file for the scanner of loadTrackFast.
+
+       Return None if the file contains anything the scanner does not
+       understand (see FAST_UNEXPECTED), is empty, compressed or not in an
+       ASCII-compatible encoding.
+    """
+    with open(filename, "rb") as file:
+        try:
+            data = mmap(file.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            # an empty file
+            return None
+    if any(data[:len(prefix)] == prefix for (prefix, module) in COMPRESSIONS) or b"\0" in data[:4]:
+        return None
+    if FAST_UNEXPECTED.search(data):
+        return None
+    return data
+
+def scanTrackpoints(data, start, end, window=None, ordered=False):
+    """Scan the trackpoints in data[start:end], which must not cut through a
+       <trkpt>, for loadTrackFast.
+
+       Return the columns (time, lat, lon, ele) in file order, the indexes
+       into them at which a <trkseg> starts (one past the end for a <trkseg>
+       after the last trackpoint) and whether the scan stopped
+       early after the window, or None if a <trkpt> could not be understood.
+    """
+    opening = [match.start() for match in FAST_OPEN.finditer(data, start, end)]
+    trksegs = [match.start() for match in FAST_TRKSEG.finditer(data, start, end)]
+    try:
+        if window is None:
+            # if all trackpoints look alike, convert them column by column
+            records = FAST_REGULAR.findall(data, start, end)
+            if len(records) == len(opening):
+                lats, lons, eles, times = zip(*records) if records else ((), (), (), ())
+                return ((array('d', [parseTime(time.decode("ascii").strip()) for time in times]),
+                         array('d', map(float, lats)), array('d', map(float, lons)), array('d', map(float, eles))),
+                        array('q', [bisect_left(opening, trkseg) for trkseg in trksegs]), False)
+        position = timeWindow(*window) if window is not None else None
+        times, lats, lons, eles = array('d'), array('d'), array('d'), array('d')
+        segments = array('q')
+        count, stop = 0, None
+        for match in FAST_TRKPT.finditer(data, start, end):
+            count += 1
+            while len(segments) < len(trksegs) and trksegs[len(segments)] < match.start():
+                segments.append(len(times))
+            attributes, body = match.groups()
+            time, ele = FAST_TIME.findall(body), FAST_ELE.findall(body)
+            if len(time) > 1 or len(ele) > 1 or b"<trkpt" in body:
+                return None
+            time = time[0].strip().decode("ascii") if time else None
+            if not time:
+                continue
+            where = position(time) if position is not None else 0
+            if where > 0 and ordered:
+                stop = match.end()
+                break
+            if where != 0:
+                continue
+            lat, lon = FAST_LAT.search(attributes), FAST_LON.search(attributes)
+            if lat is None or lon is None:
+                return None
+            times.append(parseTime(time))
+            lats.append(float(lat.group(1)))
+            lons.append(float(lon.group(1)))
+            eles.append(float(ele[0]) if ele and ele[0] else 0.0)
+    except ValueError:
+        return None
+    # every <trkpt> up to where we stopped must have been matched
+    if stop is not None:
+        opening = [position for position in opening if position < stop]
+    if len(opening) != count:
+        return None
+    if stop is None:
+        segments.extend(len(times) for trkseg in trksegs[len(segments):])
+    return ((times, lats, lons, eles), segments, stop is not None)
+
+def loadTrackFast(filename, window=None, ordered=False):
+    """Load the trackpoints of a GPX file like loadTrack but by scanning the
+       bytes of the memory-mapped file with regular expressions instead of
+       parsing XML.
+
+       Return None if the file cannot be scanned (see mapTrackFile and
+       scanTrackpoints); it must then be parsed as XML.
+    """
+    data = mapTrackFile(filename)
+    if data is None:
+        return None
+    scanned = scanTrackpoints(data, 0, len(data), window, ordered)
+    if scanned is None:
+        return None
+    return TrackStore(*scanned[0], segments=scanned[1])
+
+def loadTrackChunk(filename, start, end, window=None, ordered=False):
+    """Scan the trackpoints in bytes start to end of a GPX file, see loadTrackChunked.
+
+       Return a TrackStore, the indexes at which a <trkseg> starts (see
+       scanTrackpoints), the (first, last) times of the segments in file
+       order and whether the scan stopped early, or None.
+    """
+    with open(filename, "rb") as file:
+        data = mmap(file.fileno(), 0, access=ACCESS_READ)
+    scanned = scanTrackpoints(data, start, end, window, ordered)
+    if scanned is None:
+        return None
+    columns, segments, stopped = scanned
+    return (TrackStore(*columns, segments=segments), segments, segmentSpans(columns[0], segments), stopped)
+
+def chunkBoundaries(data, count):
+    """Split data into at most count byte ranges of about the same size,
+       starting at a <trkpt> (except for the first one).
+    """
+    boundaries = [0]
+    for i in range(1, count):
+        position = data.find(b"<trkpt", max(len(data)*i // count, boundaries[-1] + 1))
+        if position < 0:
+            break
+        boundaries.append(position)
+    boundaries.append(len(data))
+    return list(zip(boundaries, boundaries[1:]))
+
+def loadTrackChunked(filename, processes=None, window=None, ordered=False):
+    """Load the trackpoints of a GPX file like loadTrackFast, but scan chunks
+       of the file in parallel in a pool of processes (by default as many as
+       there are CPUs).
+
+       The result is the same as that of loadTrack, including the order of
+       trackpoints with equal times. Return None if the file cannot be
+       scanned.
+    """
+    data = mapTrackFile(filename)
+    if data is None:
+        return None
+    chunks = chunkBoundaries(data, processes or os.cpu_count() or 1)
+    data.close()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        scanned = list(pool.map(partial(loadTrackChunk, filename, window=window, ordered=ordered), *zip(*chunks)))
+    if None in scanned:
+        return None
+    tracks, spans = [], []
+    # whether a <trkseg> started after the last trackpoint so far
+    pending = False
+    for (track, segments, trackSpans, stopped) in scanned:
+        tracks.append(track)
+        if spans and trackSpans and not pending and 0 not in segments:
+            # the first segment of the chunk continues the last one before
+            first, last = spans.pop(), trackSpans[0]
+            trackSpans = [(min(first[0], last[0]), max(first[1], last[1]))] + trackSpans[1:]
+        spans.extend(trackSpans)
+        pending = len(track) in segments or (pending and not len(track))
+        if stopped:
+            # the serial scan would not have looked any further
+            break
+    return concatTracks(tracks, spans)
+
+def expandFilenames(patterns):
+    """Expand the shell-style wildcards in a list of filenames; names that
+       match no file are kept as they are.
+    """
+    filenames = []
+    for pattern in patterns:
+        filenames.extend(sorted(glob(pattern)) or [pattern])
+    return filenames
+
+def loadTracks(filenames, processes=None, cacheDirectory=None, rebuildCache=False, window=None, ordered=False, fast=False):
+    """Load several GPX files into a single TrackStore, see mergeTracks.
+
+       The files are parsed in parallel by a pool of processes (by default
+       as many as there are CPUs). With a cacheDirectory, tracks are taken
+       from the cache there (see trackcache) unless rebuildCache is set, and
+       the tracks that had to be parsed are cached for the next run. Tracks
+       parsed only within a window (see iterTrackpointValues) are not
+       cached; cached tracks are used whole. fast is passed on to loadTrack;
+       a single large file is then scanned in parallel (see loadTrackChunked).
+    """
+    load = partial(loadTrack, window=window, ordered=ordered, fast=fast)
+    tracks = [None] * len(filenames)
+    if cacheDirectory is not None and not rebuildCache:
+        tracks = [lookupTrack(filename, cacheDirectory) for filename in filenames]
+    missing = [i for (i, track) in enumerate(tracks) if track is None]
+    if len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parsed = list(pool.map(load, [filenames[i] for i in missing]))
+    elif missing and fast and os.path.getsize(filenames[missing[0]]) >= CHUNKED_SIZE:
+        parsed = [loadTrackChunked(filenames[missing[0]], processes, window, ordered) or load(filenames[missing[0]])]
+    else:
+        parsed = [load(filenames[i]) for i in missing]
+    for (i, track) in zip(missing, parsed):
+        tracks[i] = track
+        if cacheDirectory is not None and window is None:
+            storeTrack(filenames[i], cacheDirectory, track)
+    if len(tracks) == 1:
+        return tracks[0]
+    return mergeTracks(tracks)
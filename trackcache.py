@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# An on-disk cache of parsed GPX tracks
+#
+# Every GPX file gets a cache file holding the columns of its TrackStore as
+# raw doubles, followed by the indexes at which its segments start as 64 bit
+# integers. A warm cache file is memory-mapped instead of parsing the GPX
+# file again.
+#
+# The cache file is named after the path of its GPX file alone, so that a
+# GPX file that changes replaces its cache file rather than adding another;
+# the header holds the key of the contents it was made from.
+#
+
+import os, sys, struct
+from array import array
+from hashlib import sha1
+from mmap import mmap, ACCESS_READ
+from tempfile import NamedTemporaryFile
+from trackstore import TrackStore, numpy
+
+MAGIC = b"GEOTAGT2"
+# magic, byte order of the numbers, number of trackpoints, key of the GPX
+# file, number of segments
+HEADER = struct.Struct("<8s8sQ20sQ")
+# the columns start after the header, aligned for doubles
+OFFSET = 64
+COLUMNS = ("time", "lat", "lon", "ele", "x", "y", "z")
+# how much of the beginning and the end of a GPX file goes into its key
+SAMPLE = 1 << 16
+
+
+def defaultDirectory():
+    """Return the directory for cache files, ~/.cache/geotag unless XDG_CACHE_HOME says otherwise.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "geotag")
+
+def sourceKey(filename):
+    """Return the digest identifying the current contents of a GPX file.
+
+       It covers the absolute path, size and modification time of the file
+       and hashes its first and last 64 KiB, so it can be computed in
+       constant time however large the file is.
+    """
+    stat = os.stat(filename)
+    key = sha1(("%s\0%d\0%d\0" % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)).encode("utf-8", "surrogateescape"))
+    with open(filename, "rb") as file:
+        key.update(file.read(SAMPLE))
+        if stat.st_size > SAMPLE:
+            file.seek(max(SAMPLE, stat.st_size - SAMPLE))
+            key.update(file.read(SAMPLE))
+    return key.digest()
+
+def cacheFilename(filename, directory):
+    """Return the name of the cache file for a GPX file.
+    """
+    return os.path.join(directory, sha1(os.path.abspath(filename).encode("utf-8", "surrogateescape")).hexdigest() + ".track")
+
+def readTrack(filename, key):
+    """Memory-map a cache file as a TrackStore.
+
+       Return None if the file does not exist or does not belong to key.
+    """
+    try:
+        with open(filename, "rb") as file:
+            data = mmap(file.fileno(), 0, access=ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(data) < OFFSET:
+        return None
+    magic, byteorder, count, fileKey, segments = HEADER.unpack_from(data)
+    if magic != MAGIC or byteorder.rstrip(b"\0") != sys.byteorder.encode() or fileKey != key \
+            or len(data) != OFFSET + 8*count*len(COLUMNS) + 8*segments:
+        return None
+    if numpy is not None:
+        columns = [numpy.frombuffer(data, dtype=numpy.float64, count=count, offset=OFFSET + 8*count*i) for i in range(len(COLUMNS))]
+    else:
+        view = memoryview(data)
+        columns = [view[OFFSET + 8*count*i:OFFSET + 8*count*(i+1)].cast("d") for i in range(len(COLUMNS))]
+    segments = array('q')
+    segments.frombytes(data[OFFSET + 8*count*len(COLUMNS):])
+    return TrackStore.fromColumns(*columns, segments=segments)
+
+def writeTrack(filename, key, track):
+    """Write the columns of track to a cache file for key.
+
+       The file is replaced atomically so that concurrent runs never see a
+       partial cache file.
+    """
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    with NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as file:
+        try:
+            file.write(HEADER.pack(MAGIC, sys.byteorder.encode(), len(track), key, len(track.segments)).ljust(OFFSET, b"\0"))
+            for name in COLUMNS:
+                file.write(memoryview(getattr(track, name)).cast("B"))
+            file.write(array('q', track.segments).tobytes())
+        except:
+            os.unlink(file.name)
+            raise
+    os.replace(file.name, filename)
+
+def lookupTrack(filename, directory):
+    """Return the cached TrackStore of a GPX file from directory, or None if
+       there is no valid cache file for its current contents.
+    """
+    try:
+        key = sourceKey(filename)
+    except OSError:
+        return None
+    return readTrack(cacheFilename(filename, directory), key)
+
+def storeTrack(filename, directory, track):
+    """Cache the TrackStore of a GPX file in directory.
+
+       A cache that cannot be written is not an error; the next run just
+       parses the GPX file again.
+    """
+    try:
+        key = sourceKey(filename)
+        writeTrack(cacheFilename(filename, directory), key, track)
+    except OSError:
+        pass
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# A library of tracklogs, indexed by time
+#
+# GPX files are ingested once into an SQLite database where their trackpoints
+# are kept in blocks of consecutive points. Loading the track for some time
+# span then only reads the blocks overlapping it, however many years of logs
+# the library holds. The time span of every track segment is kept as well, so
+# that the loaded track knows where its segments start.
+#
+
+import os, sys, sqlite3
+from array import array
+from gpxparse import loadTrack
+from trackstore import TrackStore, mergeTracks, segmentStarts
+
+SQLITE_MAGIC = b"SQLite format 3\0"
+# the most trackpoints in a block
+BLOCK_POINTS = 4096
+# the longest time span of a block in seconds; this bounds how far before a
+# time span a block overlapping it can start
+BLOCK_SPAN = 24*60*60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    file INTEGER NOT NULL REFERENCES files (id),
+    first REAL NOT NULL,
+    last REAL NOT NULL,
+    count INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_by_time ON blocks (first);
+CREATE TABLE IF NOT EXISTS segments (
+    file INTEGER NOT NULL REFERENCES files (id),
+    first REAL NOT NULL,
+    last REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_by_time ON segments (first);
+"""
+
+
+def isTrackLibrary(filename):
+    """Return whether filename is a tracklog library rather than a GPX file.
+    """
+    try:
+        with open(filename, "rb") as file:
+            return file.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+def packColumns(columns):
+    """Pack columns of doubles into bytes, little-endian one after the other.
+    """
+    data = array('d')
+    for column in columns:
+        data.extend(column)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+def unpackColumns(data, count):
+    """Unpack the columns of count doubles each packed by packColumns.
+    """
+    values = array('d')
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return [values[i*count:(i+1)*count] for i in range(len(values) // count)]
+
+def splitBlocks(times):
+    """Split a sorted time column into blocks of at most BLOCK_POINTS
+       trackpoints spanning at most BLOCK_SPAN seconds; yield (start, end)
+       index pairs.
+    """
+    start = 0
+    for index in range(1, len(times) + 1):
+        if index == len(times) or index - start == BLOCK_POINTS or times[index] - times[start] > BLOCK_SPAN:
+            yield (start, index)
+            start = index
+
+
+class TrackLibrary:
+    """A tracklog library stored in an SQLite database file
+    """
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, filename):
+        """Add the trackpoints of a GPX file to the library, replacing those
+           of an earlier version of the file.
+
+           Return False if the library is already up to date with the file.
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(filename)
+        known = self.connection.execute("SELECT id, size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+        if known is not None and known[1:] == (stat.st_size, stat.st_mtime_ns):
+            return False
+        track = loadTrack(filename)
+        with self.connection:
+            if known is not None:
+                self.connection.execute("DELETE FROM blocks WHERE file = ?", (known[0],))
+                self.connection.execute("DELETE FROM segments WHERE file = ?", (known[0],))
+                self.connection.execute("DELETE FROM files WHERE id = ?", (known[0],))
+            file = self.connection.execute("INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime_ns)).lastrowid
+            self.connection.executemany("INSERT INTO blocks (file, first, last, count, data) VALUES (?, ?, ?, ?, ?)",
+                    ((file, float(track.time[start]), float(track.time[end-1]), end - start,
+                      packColumns([column[start:end] for column in (track.time, track.lat, track.lon, track.ele)]))
+                     for (start, end) in splitBlocks(track.time)))
+            self.connection.executemany("INSERT INTO segments (file, first, last) VALUES (?, ?, ?)",
+                    ((file, first, last) for (first, last) in track.spans()))
+        return True
+
+    def loadRange(self, start, end):
+        """Return a TrackStore with (at least) all the trackpoints of the
+           library from start to end (in seconds since the epoch).
+
+           Only the blocks overlapping that time span are read.
+        """
+        # the earliest start of an overlapping block; SQLite has no infinity
+        earliest = max(start - BLOCK_SPAN, -sys.float_info.max)
+        latest = min(end, sys.float_info.max)
+        tracks = []
+        file = None
+        for (blockFile, count, data) in self.connection.execute(
+                "SELECT file, count, data FROM blocks WHERE first BETWEEN ? AND ? AND last >= ? ORDER BY file, first",
+                (earliest, latest, max(start, -sys.float_info.max))):
+            if blockFile != file:
+                file = blockFile
+                columns = [array('d') for i in range(4)]
+                tracks.append(columns)
+            for (column, values) in zip(columns, unpackColumns(data, count)):
+                column.extend(values)
+        # the blocks of every file are sorted; merge the files
+        tracks = [TrackStore(*columns) for columns in tracks]
+        track = tracks[0] if len(tracks) == 1 else mergeTracks(tracks)
+        if len(track):
+            # trackpoints of files ingested before segments were kept form
+            # segments of their own, see segmentStarts
+            track.segments = segmentStarts(track.time, self.connection.execute(
+                    "SELECT first, last FROM segments WHERE first <= ? AND last >= ?",
+                    (float(track.time[-1]), float(track.time[0]))).fetchall())
+        return track
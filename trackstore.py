@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+#
+# Column-wise storage of a GPS track
+#
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+from gpsfuncs import Trackpoint, latLonToNormal
+# NumPy is optional; without it the columns are plain arrays of doubles
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def makeColumn(values):
+    """Turn a sequence of numbers into a column of doubles: a NumPy array if
+       NumPy is available, an array.array otherwise.
+    """
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.float64)
+    if isinstance(values, array) and values.typecode == 'd':
+        return values
+    return array('d', values)
+
+def isSorted(column):
+    """Return whether column is in ascending order.
+    """
+    if numpy is not None:
+        return bool((column[1:] >= column[:-1]).all())
+    return all(a <= b for (a, b) in zip(column, islice(column, 1, None)))
+
+def sortOrder(column):
+    """Return the indexes that sort column; indexes of equal values keep their order.
+    """
+    if numpy is not None:
+        return numpy.argsort(column, kind="stable")
+    return sorted(range(len(column)), key=column.__getitem__)
+
+def takeColumn(column, order):
+    """Return the column reordered by the indexes in order.
+    """
+    if numpy is not None:
+        return column[order]
+    return array('d', [column[i] for i in order])
+
+def normalColumns(lat, lon):
+    """Return the columns x, y, z of the n-vectors for the columns lat and lon.
+    """
+    if numpy is not None:
+        lat, lon = numpy.radians(lat), numpy.radians(lon)
+        return (numpy.cos(lat)*numpy.cos(lon), numpy.cos(lat)*numpy.sin(lon), numpy.sin(lat))
+    x, y, z = array('d'), array('d'), array('d')
+    for point in zip(lat, lon):
+        normal = latLonToNormal(*point)
+        x.append(normal[0])
+        y.append(normal[1])
+        z.append(normal[2])
+    return x, y, z
+
+def segmentSpans(time, segments):
+    """Return the (first, last) time of each segment of a time column, in
+       the order of the segments, where segments holds the indexes at which
+       segments start; the column need not be sorted, and segments without
+       trackpoints are left out.
+    """
+    bounds = sorted(set(index for index in segments if 0 < index < len(time)) | {0}) + [len(time)]
+    if not len(time):
+        return []
+    if numpy is not None:
+        starts = numpy.array(bounds[:-1], dtype=numpy.intp)
+        return list(zip(numpy.minimum.reduceat(time, starts).tolist(), numpy.maximum.reduceat(time, starts).tolist()))
+    return [(min(time[start:end]), max(time[start:end])) for (start, end) in zip(bounds, bounds[1:])]
+
+def segmentStarts(time, spans):
+    """Return the indexes at which the segments of a sorted time column
+       start, given the (first, last) times of the segments as recorded.
+
+       Segments overlapping in time become one, since their trackpoints are
+       interleaved; trackpoints outside of all spans form segments of their
+       own.
+    """
+    starts = {0} if len(time) else set()
+    first = last = None
+    for span in sorted(spans) + [None]:
+        if span is not None and last is not None and span[0] <= last:
+            last = max(last, span[1])
+            continue
+        if last is not None:
+            starts.add(bisect_left(time, first))
+            starts.add(bisect_right(time, last))
+        if span is not None:
+            first, last = span
+    return array('q', sorted(start for start in starts if start < len(time)))
+
+
+class TimeIndex:
+    """A direct-address index over a sorted time column
+
+       Time is cut into buckets of a fixed width, by default the typical
+       sampling interval of the track, and the index keeps the first
+       trackpoint of every bucket. Finding a time is then a division plus a
+       short scan within its bucket; buckets with more than MAX_SCAN
+       trackpoints, as with irregular sampling, are bisected instead. The
+       number of buckets is limited to a few per trackpoint, so long gaps
+       in the track only make the buckets wider.
+    """
+    MAX_SCAN = 8
+    # how many pairs of consecutive trackpoints to look at for the sampling interval
+    SAMPLES = 1001
+
+    def __init__(self, times, width=None):
+        self.times = times
+        self.start = float(times[0]) if len(times) else 0.
+        self.last = float(times[-1]) if len(times) else 0.
+        span = self.last - self.start
+        if width is None:
+            step = max(1, (len(times) - 1) // self.SAMPLES)
+            deltas = sorted(float(times[i+1]) - float(times[i]) for i in range(0, len(times) - 1, step))
+            deltas = [delta for delta in deltas if delta > 0]
+            width = deltas[len(deltas)//2] if deltas else 1.
+        self.width = max(width, span / (4*len(times) + 1))
+        buckets = int(span / self.width) + 1
+        while self.start + buckets*self.width <= self.last:
+            buckets += 1
+        self.buckets = buckets
+        if numpy is not None:
+            first = numpy.searchsorted(times, self.start + numpy.arange(buckets + 1)*self.width, "left")
+            # for searchAll; plain integers are quicker to look up one at a time
+            self.firstColumn = first.astype(numpy.int64)
+            self.first = array('q')
+            self.first.frombytes(first.astype(numpy.int64).tobytes())
+        else:
+            self.first = array('q')
+            index = 0
+            for bucket in range(buckets + 1):
+                bound = self.start + bucket*self.width
+                while index < len(times) and times[index] < bound:
+                    index += 1
+                self.first.append(index)
+
+    def search(self, time):
+        """Return the index of the first time in the column not before time.
+        """
+        start, times = self.start, self.times
+        if not start < time <= self.last:
+            # before or after the track, or NaN
+            return bisect_left(times, time)
+        bucket = int((time - start) / self.width)
+        if bucket >= self.buckets:
+            bucket = self.buckets - 1
+        low, high = self.first[bucket], self.first[bucket + 1]
+        # the division may put time into a neighbouring bucket
+        if (low and times[low-1] >= time) or (high < len(times) and times[high] < time):
+            return bisect_left(times, time)
+        if high - low > self.MAX_SCAN:
+            return bisect_left(times, time, low, high)
+        while low < high and times[low] < time:
+            low += 1
+        return low
+
+    def searchAll(self, times):
+        """Return search for every time of a NumPy array at once; needs NumPy.
+
+           The scan of a bucket becomes MAX_SCAN comparisons over all times;
+           the times that their buckets do not settle are bisected.
+        """
+        column = numpy.asarray(self.times)
+        if len(column) == 0:
+            return numpy.zeros(len(times), dtype=numpy.int64)
+        # NaN is not inside either
+        inside = (times > self.start) & (times <= self.last)
+        bucket = ((numpy.where(inside, times, self.start) - self.start) / self.width).astype(numpy.int64)
+        bucket = numpy.minimum(bucket, self.buckets - 1)
+        low, high = self.firstColumn[bucket], self.firstColumn[bucket + 1]
+        last = len(column) - 1
+        indexes = low.copy()
+        for step in range(self.MAX_SCAN):
+            indexes += (low + step < high) & (column[numpy.minimum(low + step, last)] < times)
+        # the division may put time into a neighbouring bucket, see search
+        unsettled = ~inside | (high - low > self.MAX_SCAN) \
+                    | ((low > 0) & (column[numpy.maximum(low - 1, 0)] >= times)) \
+                    | ((high <= last) & (column[numpy.minimum(high, last)] < times))
+        indexes[unsettled] = numpy.searchsorted(column, times[unsettled], "left")
+        return indexes
+
+
+class TrackStore:
+    """The trackpoints of a track, sorted by time
+
+       The track is held as parallel columns time, lat, lon and ele (see
+       makeColumn) rather than as one Trackpoint per point; indexing the
+       store gives a Trackpoint view of a single point. The columns x, y
+       and z hold the n-vector of every trackpoint (see latLonToNormal) so
+       that interpolating needs no trigonometry on the trackpoints.
+
+       segments holds the indexes at which the track segments (<trkseg>)
+       start; trackpoints are only interpolated within a segment.
+    """
+    # see indexTime and tabulateSegments
+    timeIndex = None
+    slopes = None
+
+    def __init__(self, time=(), lat=(), lon=(), ele=(), segments=None):
+        """segments are the indexes into the columns as given at which
+           segments start; by default the track is a single segment.
+        """
+        columns = [makeColumn(column) for column in (time, lat, lon, ele)]
+        if len(set(len(column) for column in columns)) > 1:
+            raise ValueError("the columns of a track must have the same length")
+        spans = segmentSpans(columns[0], segments if segments is not None else ())
+        if not isSorted(columns[0]):
+            order = sortOrder(columns[0])
+            columns = [takeColumn(column, order) for column in columns]
+        self.time, self.lat, self.lon, self.ele = columns
+        self.x, self.y, self.z = normalColumns(self.lat, self.lon)
+        self.segments = segmentStarts(self.time, spans)
+
+    @classmethod
+    def fromColumns(cls, time, lat, lon, ele, x, y, z, segments=None):
+        """Create a store around existing columns, which must already be
+           sorted by time and have the same length, without copying them.
+           segments are the indexes at which segments start, see TrackStore.
+        """
+        track = cls.__new__(cls)
+        track.time, track.lat, track.lon, track.ele = time, lat, lon, ele
+        track.x, track.y, track.z = x, y, z
+        track.segments = array('q', segments if segments is not None else [0] if len(time) else [])
+        return track
+
+    def indexTime(self, width=None):
+        """Build a TimeIndex over the time column for searchTime to use.
+        """
+        self.timeIndex = TimeIndex(self.time, width)
+
+    def tabulateSegments(self):
+        """Precompute the linear interpolation between neighbouring trackpoints.
+
+           slopes becomes a tuple of the columns dx, dy, dz and dele: at
+           index i, the change per second of x, y, z and ele on the stretch
+           ending in trackpoint i, which starts at the first trackpoint with
+           the time of trackpoint i-1. A time t on that stretch then
+           interpolates to x[i] + dx[i]*(t - time[i]) and so on. Index 0 and
+           trackpoints sharing the time of their predecessor get slope 0.
+        """
+        values = (self.x, self.y, self.z, self.ele)
+        if numpy is not None:
+            before = numpy.searchsorted(self.time, self.time[:-1], "left")
+            span = self.time[1:] - self.time[before]
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                self.slopes = tuple(numpy.concatenate(([0.], numpy.where(span > 0, (column[1:] - column[before]) / span, 0.)))
+                                    for column in values)
+            return
+        slopes = tuple(array('d', [0.]) for column in values)
+        before = 0
+        for index in range(1, len(self)):
+            if self.time[index-1] != self.time[before]:
+                before = index - 1
+            span = self.time[index] - self.time[before]
+            for (slope, column) in zip(slopes, values):
+                slope.append((column[index] - column[before]) / span if span > 0 else 0.)
+        self.slopes = slopes
+
+    def spans(self):
+        """Return the (first, last) time of each segment.
+        """
+        return segmentSpans(self.time, self.segments)
+
+    def segmentOf(self, index):
+        """Return the number of the segment of the trackpoint at index.
+        """
+        return bisect_right(self.segments, index) - 1
+
+    def searchTime(self, time):
+        """Return the index of the first trackpoint whose time is not before time.
+        """
+        if self.timeIndex is not None:
+            return self.timeIndex.search(time)
+        if numpy is not None:
+            return int(numpy.searchsorted(self.time, time, "left"))
+        return bisect_left(self.time, time)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("trackpoint index out of range")
+        return Trackpoint(float(self.lat[index]), float(self.lon[index]), float(self.ele[index]), float(self.time[index]))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return "TrackStore(%d trackpoints)" % len(self)
+
+
+def concatTracks(tracks, spans=None):
+    """Concatenate TrackStores into one as if all their trackpoints had been
+       given to TrackStore in that order.
+
+       spans are the (first, last) times of the segments of the result, by
+       default those of the segments of all tracks.
+    """
+    if spans is None:
+        spans = [span for track in tracks for span in track.spans()]
+    columns = []
+    for name in ("time", "lat", "lon", "ele", "x", "y", "z"):
+        parts = [getattr(track, name) for track in tracks]
+        if numpy is not None:
+            columns.append(numpy.concatenate(parts) if parts else numpy.zeros(0))
+        else:
+            column = array('d')
+            for part in parts:
+                column.extend(part)
+            columns.append(column)
+    if not isSorted(columns[0]):
+        order = sortOrder(columns[0])
+        columns = [takeColumn(column, order) for column in columns]
+    return TrackStore.fromColumns(*columns, segments=segmentStarts(columns[0], spans))
+
+def mergeTracks(tracks):
+    """Merge several TrackStores into one with a k-way merge of their sorted columns.
+
+       Trackpoints with equal times are taken in the order of tracks, and a
+       trackpoint that repeats the previous one exactly (as where two
+       consecutive log files overlap) is kept only once. Segments of
+       different tracks that overlap in time become one.
+    """
+    columns = [array('d') for i in range(4)]
+    last = None
+    for point in merge(*[zip(track.time, track.lat, track.lon, track.ele) for track in tracks], key=itemgetter(0)):
+        if point == last:
+            continue
+        for (column, value) in zip(columns, point):
+            column.append(value)
+        last = point
+    merged = TrackStore(*columns)
+    merged.segments = segmentStarts(merged.time, [span for track in tracks for span in track.spans()])
+    return merged
+
+
+class CompactColumn:
+    """A read-only column of a CompactTrack, decoding blocks as they are accessed
+    """
+    def __init__(self, track, column):
+        self.track = track
+        self.column = column
+
+    def __len__(self):
+        return len(self.track)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.track)
+        if not 0 <= index < len(self.track):
+            raise IndexError("trackpoint index out of range")
+        block = bisect_right(self.track.blockStart, index) - 1
+        return self.track.decode(block)[self.column][index - self.track.blockStart[block]]
+
+    def __iter__(self):
+        for block in range(len(self.track.blockStart)):
+            for value in self.track.decode(block)[self.column]:
+                yield value
+
+
+class CompactTrack:
+    """A read-only track like a TrackStore that takes about a quarter of the memory
+
+       Latitudes and longitudes are stored as 32 bit integers in
+       microdegrees (off by at most 0.5e-6 degrees, about 6 cm), elevations
+       as 16 bit integers in decimetres relative to a base elevation per
+       block (off by at most 5 cm; elevations more than 3276.7 m away from
+       the middle of their block are clamped), and times as 32 bit integer
+       milliseconds after the first time of their block (off by at most
+       0.5 ms). That is 14 bytes per trackpoint against 56 for the columns
+       of a TrackStore and about 160 for a Trackpoint object in a list.
+
+       A block holds at most BLOCK_SIZE consecutive trackpoints, fewer if
+       they span more than 2**32 ms. The columns time, lat, lon, ele, x, y
+       and z decode only the blocks that are accessed; the last few decoded
+       blocks are kept around.
+    """
+    BLOCK_SIZE = 256
+    # how many decoded blocks to keep
+    DECODED = 8
+    # there is no TrackStore.tabulateSegments or indexTime for compact tracks
+    slopes = None
+    timeIndex = None
+    segmentOf = TrackStore.segmentOf
+
+    def __init__(self, track):
+        # the index, time and base elevation of the first trackpoint of each block
+        self.blockStart, self.blockTime, self.blockEle = array('q'), array('d'), array('d')
+        self.latE6, self.lonE6, self.eleDm, self.timeMs = array('i'), array('i'), array('h'), array('I')
+        for index in range(len(track)):
+            time = float(track.time[index])
+            if not self.blockStart or index - self.blockStart[-1] == self.BLOCK_SIZE \
+                    or round((time - self.blockTime[-1])*1000) > 0xffffffff:
+                end = min(index + self.BLOCK_SIZE, len(track))
+                eles = [track.ele[i] for i in range(index, end)]
+                self.blockStart.append(index)
+                self.blockTime.append(time)
+                self.blockEle.append(round((min(eles) + max(eles))*5)/10.)
+            self.latE6.append(round(track.lat[index]*1e6))
+            self.lonE6.append(round(track.lon[index]*1e6))
+            self.eleDm.append(max(-0x8000, min(0x7fff, round((track.ele[index] - self.blockEle[-1])*10))))
+            self.timeMs.append(round((time - self.blockTime[-1])*1000))
+        self.segments = array('q', track.segments)
+        self.decoded = OrderedDict()
+        self.time, self.lat, self.lon, self.ele, self.x, self.y, self.z = [CompactColumn(self, column) for column in range(7)]
+
+    def decode(self, block):
+        """Return the columns time, lat, lon, ele, x, y and z of a block.
+        """
+        if block in self.decoded:
+            self.decoded.move_to_end(block)
+            return self.decoded[block]
+        start = self.blockStart[block]
+        end = self.blockStart[block+1] if block + 1 < len(self.blockStart) else len(self)
+        time, ele = self.blockTime[block], self.blockEle[block]
+        lat = array('d', [value/1e6 for value in self.latE6[start:end]])
+        lon = array('d', [value/1e6 for value in self.lonE6[start:end]])
+        columns = (array('d', [time + value/1000. for value in self.timeMs[start:end]]), lat, lon,
+                   array('d', [ele + value/10. for value in self.eleDm[start:end]])) + tuple(normalColumns(lat, lon))
+        self.decoded[block] = columns
+        if len(self.decoded) > self.DECODED:
+            self.decoded.popitem(last=False)
+        return columns
+
+    def searchTime(self, time):
+        """Return the index of the first trackpoint whose time is not before time.
+        """
+        block = bisect_left(self.blockTime, time) - 1
+        if block < 0:
+            return 0
+        return self.blockStart[block] + bisect_left(self.decode(block)[0], time)
+
+    def __len__(self):
+        return len(self.latE6)
+
+    def __getitem__(self, index):
+        return Trackpoint(float(self.lat[index]), float(self.lon[index]), float(self.ele[index]), float(self.time[index]))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return "CompactTrack(%d trackpoints)" % len(self)